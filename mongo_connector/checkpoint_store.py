@@ -0,0 +1,185 @@
+# Copyright 2013-2014 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Places to keep the oplog progress of a Connector.
+
+The oplog progress maps the name of each OplogThread (and of each target
+system of an OplogThread) to the timestamp of the last oplog entry applied.
+The progress of a collection dump is stored as a document instead of a
+timestamp.
+"""
+
+import json
+import logging
+import numbers
+import os
+
+import pymongo
+
+from bson import json_util
+from bson.timestamp import Timestamp
+from pymongo import uri_parser
+
+from mongo_connector import util
+from mongo_connector.constants import DEFAULT_CHECKPOINT_NAME
+
+
+class CheckpointStore(object):
+    """Interface for storing the oplog progress of a Connector.
+
+    ``write`` is called about once every second by the Connector, but only
+    when the progress changed since it was last written.
+    """
+
+    def read(self):
+        """Return the stored oplog progress as a dictionary, or None if no
+        progress has been stored.
+        """
+        raise NotImplementedError
+
+    def write(self, progress):
+        """Store the oplog progress, replacing any progress stored before.
+
+        Raises an exception if the progress could not be stored.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Release any resources held by this store."""
+        pass
+
+
+class FileCheckpointStore(CheckpointStore):
+    """Stores the oplog progress in a JSON file.
+
+    The file contains a flat list [oplog, timestamp, oplog, timestamp, ...],
+    with timestamps written as integers.
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+
+        #Whether to flush the file to disk after each write
+        self.fsync = fsync
+
+    def read(self):
+        # Check for empty file
+        try:
+            if os.stat(self.path).st_size == 0:
+                logging.info("MongoConnector: Empty oplog progress file.")
+                return None
+        except OSError:
+            return None
+
+        source = open(self.path, 'r')
+        try:
+            data = json.load(source, object_hook=json_util.object_hook)
+        except ValueError:       # empty file
+            reason = "It may be empty or corrupt."
+            logging.info("MongoConnector: Can't read oplog progress file. %s" %
+                         (reason))
+            source.close()
+            return None
+
+        source.close()
+
+        progress = {}
+        for count in range(0, len(data), 2):
+            oplog_str = data[count]
+            time_stamp = data[count + 1]
+            if isinstance(time_stamp, numbers.Integral):
+                #stored as bson_ts
+                progress[oplog_str] = util.long_to_bson_ts(time_stamp)
+            else:
+                #progress of a collection dump
+                progress[oplog_str] = time_stamp
+        return progress
+
+    def write(self, progress):
+        # The progress of a collection dump is written as a document in
+        # place of the timestamp.
+        data = []
+        for oplog, time_stamp in progress.items():
+            if time_stamp is None:
+                continue
+            data.append(str(oplog))
+            if isinstance(time_stamp, Timestamp):
+                data.append(util.bson_ts_to_long(time_stamp))
+            else:
+                data.append(time_stamp)
+        json_str = json.dumps(data, default=json_util.default)
+        util.write_file_atomically(self.path, json_str, fsync=self.fsync)
+
+    def __str__(self):
+        return self.path
+
+
+class MongoCheckpointStore(CheckpointStore):
+    """Stores the oplog progress in a document of a MongoDB collection.
+
+    The store is given a MongoDB URI such as
+    ``mongodb://host1,host2/database.collection?replicaSet=rs&w=majority``,
+    whose write concern applies to every write. The database and collection
+    default to ``__mongo_connector.checkpoints``. Each Connector keeps its
+    progress in the document whose ``_id`` is ``name``, so a Connector
+    started elsewhere with the same name resumes where it left off.
+    """
+
+    def __init__(self, uri, name=DEFAULT_CHECKPOINT_NAME):
+        parsed = uri_parser.parse_uri(uri)
+        database = parsed['database'] or '__mongo_connector'
+        collection = parsed['collection'] or 'checkpoints'
+        self.client = pymongo.MongoClient(uri)
+        self.collection = self.client[database][collection]
+        self.name = name
+
+    def read(self):
+        document = util.retry_until_ok(self.collection.find_one,
+                                       {'_id': self.name})
+        if document is None:
+            return None
+        progress = {}
+        for entry in document.get('progress', []):
+            if 'ts' in entry:
+                progress[entry['key']] = entry['ts']
+            else:
+                # Collection names may contain dots, which aren't allowed in
+                # the keys of a document, so the progress of a collection
+                # dump is stored as JSON.
+                progress[entry['key']] = json.loads(
+                    entry['dump'], object_hook=json_util.object_hook)
+        return progress
+
+    def write(self, progress):
+        entries = []
+        for key, value in sorted(progress.items(),
+                                 key=lambda item: str(item[0])):
+            if value is None:
+                continue
+            elif isinstance(value, Timestamp):
+                entries.append({'key': str(key), 'ts': value})
+            else:
+                entries.append({
+                    'key': str(key),
+                    'dump': json.dumps(value, default=json_util.default)})
+        self.collection.update({'_id': self.name},
+                               {'$set': {'progress': entries}},
+                               upsert=True)
+
+    def close(self):
+        self.client.close()
+
+    def __str__(self):
+        # Leave out the URI, which may contain a password
+        return "document %r in %s" % (self.name, self.collection.full_name)
@@ -21,12 +21,11 @@ import optparse
 import os
 import pymongo
 import re
-import shutil
 import sys
 import threading
 import time
 import imp
-from mongo_connector import constants, errors, util
+from mongo_connector import checkpoint_store, constants, errors, metrics
 from mongo_connector.locking_dict import LockingDict
 from mongo_connector.oplog_manager import OplogThread
 from mongo_connector.doc_managers import doc_manager_simulator as simulator
@@ -42,7 +41,17 @@ class Connector(threading.Thread):
                  collection_dump=True, batch_size=constants.DEFAULT_BATCH_SIZE,
                  fields=None, dest_mapping={},
                  auto_commit_interval=constants.DEFAULT_COMMIT_INTERVAL,
-                 continue_on_error=False):
+                 continue_on_error=False,
+                 buffer_size=constants.DEFAULT_BUFFER_SIZE,
+                 buffer_timeout=constants.DEFAULT_BUFFER_TIMEOUT,
+                 worker_queue_size=constants.DEFAULT_WORKER_QUEUE_SIZE,
+                 dump_workers=constants.DEFAULT_DUMP_WORKERS,
+                 dump_chunk_size=constants.DEFAULT_DUMP_CHUNK_SIZE,
+                 trace_sample=0,
+                 summary_interval=constants.DEFAULT_SUMMARY_INTERVAL,
+                 fsync_checkpoint=False,
+                 checkpoint_name=constants.DEFAULT_CHECKPOINT_NAME,
+                 doc_manager_options=None):
 
         if target_url and not doc_manager:
             raise errors.ConnectorError("Cannot create a Connector with a "
@@ -81,7 +90,8 @@ class Connector(threading.Thread):
         #can_run is set to false when we join the thread
         self.can_run = True
 
-        #The name of the file that stores the progress of the OplogThreads
+        #The name of the file that stores the progress of the OplogThreads,
+        #or the URI of a MongoDB collection that stores it.
         self.oplog_checkpoint = oplog_checkpoint
 
         #main address - either mongos for sharded setups or a primary otherwise
@@ -104,6 +114,12 @@ class Connector(threading.Thread):
         #Whether the collection dump gracefully handles exceptions
         self.continue_on_error = continue_on_error
 
+        #Num threads reading ranges of collections during a collection dump
+        self.dump_workers = dump_workers
+
+        #Max num documents upserted before recording the dump progress
+        self.dump_chunk_size = dump_chunk_size
+
         #The key that is a unique document identifier for the target system.
         #Not necessarily the mongo unique key.
         self.u_key = u_key
@@ -124,9 +140,37 @@ class Connector(threading.Thread):
         #Num entries to process before updating config file with current pos
         self.batch_size = batch_size
 
+        #Max num of oplog entries to apply to the DocManagers at once
+        self.buffer_size = buffer_size
+
+        #Max num of seconds an oplog entry may wait before being applied
+        self.buffer_timeout = buffer_timeout
+
+        #Max num of batches waiting to be applied to each DocManager
+        self.worker_queue_size = worker_queue_size
+
+        #Log one in every trace_sample oplog entries read, or none if 0
+        self.trace_sample = trace_sample
+
+        #Num seconds between summaries of the oplog entries read
+        self.summary_interval = summary_interval
+
         #Dict of OplogThread/timestamp pairs to record progress
         self.oplog_progress = LockingDict()
 
+        #Copy of the oplog progress last written to the checkpoint store
+        self.written_progress = None
+
+        #Where the oplog progress is stored, or None if it isn't
+        if oplog_checkpoint is None:
+            self.checkpoint_store = None
+        elif oplog_checkpoint.startswith("mongodb://"):
+            self.checkpoint_store = checkpoint_store.MongoCheckpointStore(
+                oplog_checkpoint, checkpoint_name)
+        else:
+            self.checkpoint_store = checkpoint_store.FileCheckpointStore(
+                oplog_checkpoint, fsync=fsync_checkpoint)
+
         # List of fields to export
         self.fields = fields
 
@@ -134,6 +178,8 @@ class Connector(threading.Thread):
             docman_kwargs = {"unique_key": u_key,
                              "namespace_set": ns_set,
                              "auto_commit_interval": auto_commit_interval}
+            # Options specific to the type of DocManager
+            docman_kwargs.update(doc_manager_options or {})
 
             # No doc managers specified, using simulator
             if doc_manager is None:
@@ -167,7 +213,8 @@ class Connector(threading.Thread):
             self.can_run = False
             return
 
-        if self.oplog_checkpoint is not None:
+        if isinstance(self.checkpoint_store,
+                      checkpoint_store.FileCheckpointStore):
             if not os.path.exists(self.oplog_checkpoint):
                 info_str = ("MongoConnector: Can't find %s, "
                             "attempting to create an empty progress log" %
@@ -197,71 +244,47 @@ class Connector(threading.Thread):
         threading.Thread.join(self)
 
     def write_oplog_progress(self):
-        """ Writes oplog progress to file provided by user
+        """ Writes oplog progress to the checkpoint store
+
+        The progress is only written if it changed since the last write.
         """
 
-        if self.oplog_checkpoint is None:
+        if self.checkpoint_store is None:
             return None
 
-        # write to temp file
-        backup_file = self.oplog_checkpoint + '.backup'
-        os.rename(self.oplog_checkpoint, backup_file)
-
-        # for each of the threads write to file
-        with open(self.oplog_checkpoint, 'w') as dest:
-            with self.oplog_progress as oplog_prog:
+        # Hold the lock only long enough to copy the progress. The values
+        # are replaced rather than modified in place, so a shallow copy is
+        # enough.
+        with self.oplog_progress as oplog_prog:
+            progress = dict(oplog_prog.get_dict())
 
-                oplog_dict = oplog_prog.get_dict()
-                for oplog, time_stamp in oplog_dict.items():
-                    oplog_str = str(oplog)
-                    timestamp = util.bson_ts_to_long(time_stamp)
-                    json_str = json.dumps([oplog_str, timestamp])
-                    try:
-                        dest.write(json_str)
-                    except IOError:
-                        # Basically wipe the file, copy from backup
-                        dest.truncate()
-                        with open(backup_file, 'r') as backup:
-                            shutil.copyfile(backup, dest)
-                        break
+        if progress == self.written_progress:
+            return None
 
-        os.remove(self.oplog_checkpoint + '.backup')
+        try:
+            self.checkpoint_store.write(progress)
+        except Exception:
+            # Keep the previous progress, and try again next time
+            logging.exception("MongoConnector: Could not write oplog "
+                              "progress to %s", self.checkpoint_store)
+            return None
+        self.written_progress = progress
 
     def read_oplog_progress(self):
-        """Reads oplog progress from file provided by user.
+        """Reads oplog progress from the checkpoint store.
         This method is only called once before any threads are spanwed.
         """
 
-        if self.oplog_checkpoint is None:
+        if self.checkpoint_store is None:
             return None
 
-        # Check for empty file
-        try:
-            if os.stat(self.oplog_checkpoint).st_size == 0:
-                logging.info("MongoConnector: Empty oplog progress file.")
-                return None
-        except OSError:
-            return None
-
-        source = open(self.oplog_checkpoint, 'r')
-        try:
-            data = json.load(source)
-        except ValueError:       # empty file
-            reason = "It may be empty or corrupt."
-            logging.info("MongoConnector: Can't read oplog progress file. %s" %
-                         (reason))
-            source.close()
+        progress = self.checkpoint_store.read()
+        if progress is None:
             return None
 
-        source.close()
-
-        count = 0
-        oplog_dict = self.oplog_progress.get_dict()
-        for count in range(0, len(data), 2):
-            oplog_str = data[count]
-            time_stamp = data[count + 1]
-            oplog_dict[oplog_str] = util.long_to_bson_ts(time_stamp)
-            #stored as bson_ts
+        with self.oplog_progress as oplog_prog:
+            oplog_prog.get_dict().update(progress)
+        self.written_progress = None
 
     def run(self):
         """Discovers the mongo cluster and creates a thread for each primary.
@@ -285,6 +308,7 @@ class Connector(threading.Thread):
                     'No replica set at "%s"! A replica set is required '
                     'to run mongo-connector. Shutting down...' % self.address
                 )
+                self.close_checkpoint_store()
                 return
 
             # Establish a connection to the replica set as a whole
@@ -312,7 +336,14 @@ class Connector(threading.Thread):
                 batch_size=self.batch_size,
                 fields=self.fields,
                 dest_mapping=self.dest_mapping,
-                continue_on_error=self.continue_on_error
+                continue_on_error=self.continue_on_error,
+                buffer_size=self.buffer_size,
+                buffer_timeout=self.buffer_timeout,
+                worker_queue_size=self.worker_queue_size,
+                dump_workers=self.dump_workers,
+                dump_chunk_size=self.dump_chunk_size,
+                trace_sample=self.trace_sample,
+                summary_interval=self.summary_interval
             )
             self.shard_set[0] = oplog
             logging.info('MongoConnector: Starting connection thread %s' %
@@ -327,6 +358,7 @@ class Connector(threading.Thread):
                     self.oplog_thread_join()
                     for dm in self.doc_managers:
                         dm.stop()
+                    self.close_checkpoint_store()
                     return
 
                 self.write_oplog_progress()
@@ -346,6 +378,7 @@ class Connector(threading.Thread):
                             self.oplog_thread_join()
                             for dm in self.doc_managers:
                                 dm.stop()
+                            self.close_checkpoint_store()
                             return
 
                         self.write_oplog_progress()
@@ -359,6 +392,7 @@ class Connector(threading.Thread):
                         self.oplog_thread_join()
                         for dm in self.doc_managers:
                             dm.stop()
+                        self.close_checkpoint_store()
                         return
 
                     shard_conn = MongoClient(hosts, replicaSet=repl_set)
@@ -374,11 +408,19 @@ class Connector(threading.Thread):
                         namespace_set=self.ns_set,
                         auth_key=self.auth_key,
                         auth_username=self.auth_username,
+                        repl_set=repl_set,
                         collection_dump=self.collection_dump,
                         batch_size=self.batch_size,
                         fields=self.fields,
                         dest_mapping=self.dest_mapping,
-                        continue_on_error=self.continue_on_error
+                        continue_on_error=self.continue_on_error,
+                        buffer_size=self.buffer_size,
+                        buffer_timeout=self.buffer_timeout,
+                        worker_queue_size=self.worker_queue_size,
+                        dump_workers=self.dump_workers,
+                        dump_chunk_size=self.dump_chunk_size,
+                        trace_sample=self.trace_sample,
+                        summary_interval=self.summary_interval
                     )
                     self.shard_set[shard_id] = oplog
                     msg = "Starting connection thread"
@@ -386,7 +428,14 @@ class Connector(threading.Thread):
                     oplog.start()
 
         self.oplog_thread_join()
+        self.close_checkpoint_store()
+
+    def close_checkpoint_store(self):
+        """Writes the final oplog progress and closes the checkpoint store.
+        """
         self.write_oplog_progress()
+        if self.checkpoint_store is not None:
+            self.checkpoint_store.close()
 
     def oplog_thread_join(self):
         """Stops all the OplogThreads
@@ -429,7 +478,33 @@ def main():
                       """cluster is restarted, it is essential that the """
                       """oplog-timestamp config file be emptied - otherwise """
                       """the connector will miss some documents and behave """
-                      """incorrectly.""")
+                      """incorrectly. """
+                      """The progress may be stored in a MongoDB collection """
+                      """instead by giving a MongoDB URI such as """
+                      """`mongodb://host/database.collection?w=majority`, """
+                      """so that another mongo-connector with the same """
+                      """--checkpoint-name can take over from this one. """
+                      """The write concern given in the URI is used to """
+                      """store the progress.""")
+
+    #--checkpoint-name names the progress stored in a MongoDB collection
+    parser.add_option("--checkpoint-name", action="store",
+                      dest="checkpoint_name",
+                      default=constants.DEFAULT_CHECKPOINT_NAME, help=
+                      "Specify the name under which the oplog progress is "
+                      "stored when --oplog-ts is a MongoDB URI. Connectors "
+                      "replicating different data into the same collection "
+                      "must use different names. The default is %s."
+                      % constants.DEFAULT_CHECKPOINT_NAME)
+
+    #--oplog-ts-fsync flushes the oplog progress file to disk on each write
+    parser.add_option("--oplog-ts-fsync", action="store_true",
+                      dest="fsync_checkpoint", default=False, help=
+                      "If specified, the file given to --oplog-ts is flushed "
+                      "to disk every time it is written, so that the latest "
+                      "progress survives a crash of the machine. The file is "
+                      "always replaced atomically, so it is never left empty "
+                      "or partially written.")
 
     #--no-dump specifies whether we should read an entire collection from
     #scratch if no timestamp is found in the oplog_config.
@@ -449,6 +524,39 @@ def main():
                       "You may want more frequent updates if you are at risk "
                       "of falling behind the earliest timestamp in the oplog")
 
+    #--oplog-buffer-size specifies the max num of oplog entries to apply to
+    #the target systems in a single batch
+    parser.add_option("--oplog-buffer-size", action="store",
+                      dest="buffer_size", type="int",
+                      default=constants.DEFAULT_BUFFER_SIZE,
+                      help="Specify the maximum number of oplog entries to "
+                      "buffer before applying them to the target systems. "
+                      "Consecutive inserts and removes in the buffer are "
+                      "sent to each target system in bulk. The default "
+                      "is %d." % constants.DEFAULT_BUFFER_SIZE)
+
+    #--oplog-buffer-timeout specifies how long an oplog entry may be buffered
+    parser.add_option("--oplog-buffer-timeout", action="store",
+                      dest="buffer_timeout", type="float",
+                      default=constants.DEFAULT_BUFFER_TIMEOUT,
+                      help="Specify the maximum number of seconds an oplog "
+                      "entry may wait in the buffer before the buffer is "
+                      "applied to the target systems. The default is %s."
+                      % constants.DEFAULT_BUFFER_TIMEOUT)
+
+    #--target-queue-size specifies how many batches of oplog entries may
+    #wait to be applied to each target system
+    parser.add_option("--target-queue-size", action="store",
+                      dest="worker_queue_size", type="int",
+                      default=constants.DEFAULT_WORKER_QUEUE_SIZE,
+                      help="Specify the maximum number of batches of oplog "
+                      "entries that may wait to be applied to each target "
+                      "system. Each target system is written to by its own "
+                      "thread, so a slow target system only holds back the "
+                      "others once this many batches are waiting for it. "
+                      "The default is %d."
+                      % constants.DEFAULT_WORKER_QUEUE_SIZE)
+
     #-t is to specify the URL to the target system being used.
     parser.add_option("-t", "--target-url", "--target-urls", action="store",
                       type="string", dest="urls", default=None, help=
@@ -538,6 +646,18 @@ def main():
                       """manager, see 'Writing Your Own DocManager' """
                       """section of the wiki""")
 
+    #--doc-manager-option passes an option to each DocManager
+    parser.add_option("--doc-manager-option", action="append",
+                      dest="doc_manager_options", default=[],
+                      metavar="NAME=VALUE", help=
+                      "Pass an option to the constructor of each doc "
+                      "manager. VALUE is read as JSON if possible, and as a "
+                      "string otherwise. For example, "
+                      "'--doc-manager-option partial_updates=true' makes the "
+                      "Elasticsearch doc manager apply $set and $unset "
+                      "updates without reading the document first. This "
+                      "flag may be given several times.")
+
     #-g is the destination namespace
     parser.add_option("-g", "--dest-namespace-set", action="store",
                       type="string", dest="dest_ns_set", default=None, help=
@@ -602,6 +722,64 @@ def main():
                       " set of documents due to errors may cause undefined"
                       " behavior. Use this flag to dump only.")
 
+    #--dump-workers to read ranges of collections concurrently during a
+    #collection dump
+    parser.add_option("--dump-workers", action="store",
+                      dest="dump_workers", type="int",
+                      default=constants.DEFAULT_DUMP_WORKERS, help=
+                      "Specify the number of threads used to dump "
+                      "collections. When greater than 1, each collection is "
+                      "split into ranges of _id that are read and upserted "
+                      "into the target systems concurrently. The default "
+                      "is %d." % constants.DEFAULT_DUMP_WORKERS)
+
+    #--dump-chunk-size to set how often a collection dump records progress
+    parser.add_option("--dump-chunk-size", action="store",
+                      dest="dump_chunk_size", type="int",
+                      default=constants.DEFAULT_DUMP_CHUNK_SIZE, help=
+                      "Specify the maximum number of documents upserted "
+                      "into the target systems at a time during a "
+                      "collection dump. The progress of the dump is "
+                      "recorded after each chunk, so a restarted dump "
+                      "repeats at most this many documents per dump "
+                      "thread. The default is %d."
+                      % constants.DEFAULT_DUMP_CHUNK_SIZE)
+
+    #--oplog-trace-sample to log a sample of the oplog entries read
+    parser.add_option("--oplog-trace-sample", action="store",
+                      dest="trace_sample", type="int", default=0, help=
+                      "Log one in every N oplog entries read, along with the "
+                      "operation it was translated into. Entries are logged "
+                      "at the DEBUG level, so this also requires -v. By "
+                      "default, no entries are logged.")
+
+    #--log-summary-interval specifies how often to log the oplog entries read
+    parser.add_option("--log-summary-interval", action="store",
+                      dest="summary_interval", type="float",
+                      default=constants.DEFAULT_SUMMARY_INTERVAL, help=
+                      "Specify the number of seconds between log messages "
+                      "summarizing the oplog entries read and the operations "
+                      "applied to the target systems, or 0 to disable these "
+                      "messages. The default is %d."
+                      % constants.DEFAULT_SUMMARY_INTERVAL)
+
+    #--metrics-port to serve metrics over HTTP
+    parser.add_option("--metrics-port", action="store", dest="metrics_port",
+                      type="int", default=None, help=
+                      "Serve metrics about the progress of mongo-connector, "
+                      "such as the number of operations replicated and the "
+                      "number of seconds each shard's checkpoint is behind "
+                      "its oplog, on http://<metrics-address>:<port>/metrics "
+                      "in the Prometheus text format. By default, metrics "
+                      "are not served.")
+
+    #--metrics-address specifies the address the metrics are served on
+    parser.add_option("--metrics-address", action="store",
+                      dest="metrics_address", default="localhost", help=
+                      "Specify the address to serve metrics on when "
+                      "--metrics-port is given. The default is localhost. "
+                      "Use 0.0.0.0 to serve metrics on all interfaces.")
+
     #-v enables vebose logging
     parser.add_option("-v", "--verbose", action="store_true",
                       dest="verbose", default=False,
@@ -703,6 +881,24 @@ def main():
     if options.commit_interval is not None and options.commit_interval < 0:
         raise ValueError("--auto-commit-interval must be non-negative")
 
+    if options.dump_chunk_size < 1:
+        raise ValueError("--dump-chunk-size must be positive")
+
+    doc_manager_options = {}
+    for option in options.doc_manager_options:
+        name, sep, value = option.partition("=")
+        if not sep or not name:
+            logger.error("Doc manager options must be given as NAME=VALUE!")
+            sys.exit(1)
+        try:
+            doc_manager_options[name] = json.loads(value)
+        except ValueError:
+            doc_manager_options[name] = value
+
+    if options.metrics_port is not None:
+        metrics.start_http_server(options.metrics_port,
+                                  options.metrics_address)
+
     connector = Connector(
         address=options.main_addr,
         oplog_checkpoint=options.oplog_config,
@@ -717,7 +913,17 @@ def main():
         fields=fields,
         dest_mapping=dest_mapping,
         auto_commit_interval=options.commit_interval,
-        continue_on_error=options.continue_on_error
+        continue_on_error=options.continue_on_error,
+        buffer_size=options.buffer_size,
+        buffer_timeout=options.buffer_timeout,
+        worker_queue_size=options.worker_queue_size,
+        dump_workers=options.dump_workers,
+        dump_chunk_size=options.dump_chunk_size,
+        trace_sample=options.trace_sample,
+        summary_interval=options.summary_interval,
+        fsync_checkpoint=options.fsync_checkpoint,
+        checkpoint_name=options.checkpoint_name,
+        doc_manager_options=doc_manager_options
     )
     connector.start()
 
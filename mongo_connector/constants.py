@@ -22,3 +22,45 @@ DEFAULT_COMMIT_INTERVAL = None
 # DocManager. This only affects DocManagers that cannot stream their
 # requests.
 DEFAULT_MAX_BULK = 500
+# Maximum # of oplog entries to buffer before applying them to the
+# DocManagers in a single batch
+DEFAULT_BUFFER_SIZE = 500
+# Maximum # of seconds an oplog entry may wait in the buffer before the
+# buffer is flushed to the DocManagers
+DEFAULT_BUFFER_TIMEOUT = 0.5
+# Maximum # of batches of oplog entries waiting to be applied to each
+# DocManager
+DEFAULT_WORKER_QUEUE_SIZE = 10
+# Number of threads reading ranges of collections during a collection dump
+# default = 1 (dump each collection with a single cursor)
+DEFAULT_DUMP_WORKERS = 1
+# Maximum # of documents upserted during a collection dump before
+# recording the progress of the dump
+DEFAULT_DUMP_CHUNK_SIZE = 1000
+# Minimum and maximum # of seconds to wait before re-opening an oplog
+# cursor that died or failed. The wait doubles after each failed attempt.
+DEFAULT_MIN_BACKOFF = 0.1
+DEFAULT_MAX_BACKOFF = 30
+# Default # of seconds between summaries of the oplog entries read
+DEFAULT_SUMMARY_INTERVAL = 60
+# Default name of the document that stores a Connector's oplog progress in
+# a MongoDB checkpoint store
+DEFAULT_CHECKPOINT_NAME = "mongo-connector"
+# Maximum # of times to retry actions of a bulk request that were rejected
+# by the target system
+DEFAULT_BULK_RETRIES = 5
+# # of seconds to wait before retrying rejected bulk actions. The wait
+# doubles after each retry, up to DEFAULT_MAX_BACKOFF.
+DEFAULT_BULK_RETRY_BACKOFF = 0.5
+# Number of concurrent scans that read the documents to roll back from a
+# target system, each over an equal part of the rollback window
+DEFAULT_SEARCH_SLICES = 4
+# # of documents fetched per scroll request by each scan
+DEFAULT_SEARCH_PAGE_SIZE = 500
+# Maximum # of documents read by the scans and not yet processed
+DEFAULT_SEARCH_BUFFER_SIZE = 10000
+# Number of threads sending bulk requests concurrently from a DocManager
+# default = 1 (send bulk requests one at a time from the calling thread)
+DEFAULT_BULK_SENDERS = 1
+# Maximum # of bulk requests waiting to be sent by each sender thread
+DEFAULT_BULK_QUEUE_SIZE = 2
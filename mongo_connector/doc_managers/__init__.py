@@ -108,6 +108,29 @@ class DocManagerBase(object):
         for doc in docs:
             self.upsert(doc)
 
+    def bulk_remove(self, docs):
+        """Remove each document in a set of documents.
+
+        This method may be overridden to remove many documents at once.
+        """
+        for doc in docs:
+            self.remove(doc)
+
+    def begin_bulk_load(self, namespaces):
+        """Called before a collection dump upserts the documents of
+        ``namespaces`` (after any renaming by the namespace mapping).
+
+        This method may be overridden to prepare the target system for a
+        large number of writes.
+        """
+        pass
+
+    def end_bulk_load(self, namespaces, success):
+        """Called after a collection dump, whether or not it succeeded, for
+        the same ``namespaces`` as ``begin_bulk_load``.
+        """
+        pass
+
     def update(self, doc, update_spec):
         """Update a document.
 
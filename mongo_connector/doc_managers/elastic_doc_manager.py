@@ -18,17 +18,29 @@ Receives documents from an OplogThread and takes the appropriate actions on
 Elasticsearch.
 """
 import logging
-
-from threading import Timer
-
-import bson.json_util
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import sys
+import threading
+import time
 
 from elasticsearch import Elasticsearch, exceptions as es_exceptions
-from elasticsearch.helpers import scan, streaming_bulk
+from elasticsearch.helpers import expand_action, scan
 
-from mongo_connector import errors
-from mongo_connector.constants import (DEFAULT_COMMIT_INTERVAL,
-                                       DEFAULT_MAX_BULK)
+from mongo_connector import errors, metrics
+from mongo_connector.compat import reraise
+from mongo_connector.constants import (DEFAULT_BULK_QUEUE_SIZE,
+                                       DEFAULT_BULK_RETRIES,
+                                       DEFAULT_BULK_SENDERS,
+                                       DEFAULT_BULK_RETRY_BACKOFF,
+                                       DEFAULT_COMMIT_INTERVAL,
+                                       DEFAULT_MAX_BACKOFF,
+                                       DEFAULT_MAX_BULK,
+                                       DEFAULT_SEARCH_BUFFER_SIZE,
+                                       DEFAULT_SEARCH_PAGE_SIZE,
+                                       DEFAULT_SEARCH_SLICES)
 from mongo_connector.util import retry_until_ok
 from mongo_connector.doc_managers import DocManagerBase, exception_wrapper
 from mongo_connector.doc_managers.formatters import DefaultDocumentFormatter
@@ -38,6 +50,86 @@ wrap_exceptions = exception_wrapper({
     es_exceptions.ConnectionError: errors.ConnectionFailed,
     es_exceptions.TransportError: errors.OperationFailed})
 
+# Statuses of bulk actions, or of whole bulk requests, that may succeed if
+# they are sent again: conflicting versions, timeouts, full queues (429) and
+# server errors
+RETRY_STATUSES = set([408, 409, 429, 500, 502, 503, 504])
+
+BULK_ITEMS = metrics.REGISTRY.register(metrics.Counter(
+    "mongo_connector_elastic_bulk_items_total",
+    "Number of Elasticsearch bulk actions that were rejected, retried, or "
+    "dropped after being rejected too many times.", ["outcome"]))
+BULK_IN_FLIGHT = metrics.REGISTRY.register(metrics.Gauge(
+    "mongo_connector_elastic_bulk_requests_in_flight",
+    "Number of Elasticsearch bulk requests waiting for a response.",
+    ["target"]))
+BULK_QUEUE_DEPTH = metrics.REGISTRY.register(metrics.Gauge(
+    "mongo_connector_elastic_bulk_requests_queued",
+    "Number of Elasticsearch bulk requests waiting for a sender thread.",
+    ["target"]))
+
+
+def log_bulk_failures(failures):
+    """Default ``bulk_failure_callback``, which logs each dropped action."""
+    for action, source, result in failures:
+        logging.error("Elasticsearch rejected bulk action %r: %r",
+                      action, result)
+
+# Groovy script that applies a $set and $unset to a document. The "sets"
+# parameter is a list of [path, value] pairs, and "unsets" is a list of
+# paths, where a path is the list of keys in a dotted field name.
+UPDATE_SCRIPT = """
+for (s in sets) {
+    def o = ctx._source; def p = s[0];
+    for (int i = 0; i < p.size() - 1; i++) {
+        def k = o instanceof List ? p[i].toInteger() : p[i];
+        if (!(o instanceof List) && o[k] == null) { o[k] = [:] };
+        o = o[k]
+    };
+    o[o instanceof List ? p[-1].toInteger() : p[-1]] = s[1]
+};
+for (p in unsets) {
+    def o = ctx._source;
+    for (int i = 0; o != null && i < p.size() - 1; i++) {
+        o = o[o instanceof List ? p[i].toInteger() : p[i]]
+    };
+    if (o instanceof List) {
+        def k = p[-1].toInteger();
+        if (k < o.size()) { o.remove((int) k) }
+    } else if (o instanceof Map) { o.remove(p[-1]) }
+}
+"""
+
+
+class _BulkBatch(object):
+    """Collects the results of the bulk requests sent by sender threads for
+    one call to ``DocManager._streaming_bulk``.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.failures = []
+        self.exc_info = None
+
+    def add(self):
+        with self.condition:
+            self.pending += 1
+
+    def done(self, failures=(), exc_info=None):
+        with self.condition:
+            self.pending -= 1
+            self.failures.extend(failures)
+            if exc_info is not None and self.exc_info is None:
+                self.exc_info = exc_info
+            self.condition.notify_all()
+
+    def wait(self):
+        """Wait until every bulk request has been sent."""
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
 
 class DocManager(DocManagerBase):
     """Elasticsearch implementation of the DocManager interface.
@@ -49,21 +141,145 @@ class DocManager(DocManagerBase):
     def __init__(self, url, auto_commit_interval=DEFAULT_COMMIT_INTERVAL,
                  unique_key='_id', chunk_size=DEFAULT_MAX_BULK,
                  meta_index_name="mongodb_meta", meta_type="mongodb_meta",
-                 **kwargs):
+                 partial_updates=False, inline_metadata=False,
+                 index_pattern="*", max_retries=DEFAULT_BULK_RETRIES,
+                 retry_backoff=DEFAULT_BULK_RETRY_BACKOFF,
+                 bulk_failure_callback=log_bulk_failures,
+                 search_slices=DEFAULT_SEARCH_SLICES,
+                 search_page_size=DEFAULT_SEARCH_PAGE_SIZE,
+                 search_buffer_size=DEFAULT_SEARCH_BUFFER_SIZE,
+                 bulk_load=False, bulk_load_alias=False,
+                 bulk_senders=DEFAULT_BULK_SENDERS,
+                 bulk_queue_size=DEFAULT_BULK_QUEUE_SIZE, **kwargs):
         self.elastic = Elasticsearch(hosts=[url])
+        # Identifies the Elasticsearch cluster in metrics, leaving out any
+        # credentials in the URL
+        self.metrics_target = url.rsplit("@", 1)[-1]
         self.auto_commit_interval = auto_commit_interval
         self.doc_type = 'string'  # default type is string, change if needed
         self.meta_index_name = meta_index_name
         self.meta_type = meta_type
         self.unique_key = unique_key
         self.chunk_size = chunk_size
+        # Apply $set and $unset with partial updates in Elasticsearch,
+        # rather than reading and indexing the whole document again
+        self.partial_updates = partial_updates
+        # Store the "ns" and "_ts" metadata fields in the documents
+        # themselves, rather than in the meta index
+        self.inline_metadata = inline_metadata
+        # Indices searched for documents during a rollback when the metadata
+        # is stored inline
+        self.index_pattern = index_pattern
+        # Number of times to resend bulk actions that Elasticsearch
+        # rejected, waiting retry_backoff seconds before the first time and
+        # twice as long each time after
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        # Called with a list of (action, source, result) for the bulk actions
+        # that are dropped after max_retries
+        self.bulk_failure_callback = bulk_failure_callback
+        # Number of concurrent scans that read the documents to roll back,
+        # the # of documents per scroll request, and the maximum # of
+        # documents read but not yet returned by search()
+        self.search_slices = search_slices
+        self.search_page_size = search_page_size
+        self.search_buffer_size = search_buffer_size
+        # Disable refreshes and replicas of the indices written to by a
+        # collection dump until it finishes
+        self.bulk_load = bulk_load
+        # Have collection dumps write to a new index, and make the index
+        # name an alias of it once the dump succeeded
+        self.bulk_load_alias = bulk_load_alias
+        # Maps index names to the new indices written to instead during a
+        # bulk load, and maps the indices being loaded to their settings
+        # before the load
+        self._load_indices = {}
+        self._load_settings = {}
+        # Number of threads sending the bulk requests of bulk_upsert and
+        # bulk_remove concurrently, and the maximum # of requests waiting
+        # for each thread. Actions are assigned to a thread by _id, so that
+        # the actions for a document are sent in order.
+        self.bulk_senders = bulk_senders
+        self.bulk_queue_size = bulk_queue_size
+        self._senders = []
+        if self.bulk_senders > 1:
+            self._start_senders()
+        if self.inline_metadata:
+            self._put_metadata_template()
+        # Indices written to since they were last refreshed
+        self._dirty_indices = set()
+        self._dirty_lock = threading.Lock()
+        # Number of bulk loads in progress, during which indices aren't
+        # refreshed automatically
+        self._bulk_loads = 0
+        # Number of calls sending bulk requests in progress, which put off
+        # automatic refreshes
+        self._bulk_requests = 0
+        self._auto_commit_stop = threading.Event()
         if self.auto_commit_interval not in [None, 0]:
             self.run_auto_commit()
         self._formatter = DefaultDocumentFormatter()
 
+    @wrap_exceptions
+    def _put_metadata_template(self):
+        """Map the inline metadata fields of new indices matching
+        ``index_pattern``.
+        """
+        self.elastic.indices.put_template(
+            name="mongo_connector_metadata",
+            body={
+                "template": self.index_pattern,
+                "mappings": {
+                    self.doc_type: {
+                        "properties": {
+                            "ns": {"type": "string", "index": "not_analyzed"},
+                            "_ts": {"type": "long"}
+                        }
+                    }
+                }
+            })
+
     def stop(self):
-        """Stop the auto-commit thread."""
+        """Stop the auto-commit and bulk sender threads."""
         self.auto_commit_interval = None
+        self._auto_commit_stop.set()
+        for lane in self._senders:
+            lane.put(None)
+        self._senders = []
+
+    def _start_senders(self):
+        """Start the threads sending bulk requests, each with its own queue.
+        """
+        for i in range(self.bulk_senders):
+            lane = queue.Queue(maxsize=max(1, self.bulk_queue_size))
+            thread = threading.Thread(target=self._run_sender, args=(lane,))
+            thread.daemon = True
+            thread.start()
+            self._senders.append(lane)
+
+    def _run_sender(self, lane):
+        """Send the chunks of actions put on a queue until None is put."""
+        while True:
+            item = lane.get()
+            if item is None:
+                return
+            BULK_QUEUE_DEPTH.inc(-1, target=self.metrics_target)
+            chunk, batch = item
+            try:
+                batch.done(failures=self._send_with_retries(chunk))
+            except Exception:
+                batch.done(exc_info=sys.exc_info())
+
+    def _enqueue_chunk(self, lane, chunk, batch):
+        """Have a sender thread send a chunk of actions."""
+        batch.add()
+        BULK_QUEUE_DEPTH.inc(target=self.metrics_target)
+        self._senders[lane].put((chunk, batch))
+
+    def _mark_dirty(self, indices):
+        """Record that some indices need to be refreshed."""
+        with self._dirty_lock:
+            self._dirty_indices.update(indices)
 
     def apply_update(self, doc, update_spec):
         if "$set" not in update_spec and "$unset" not in update_spec:
@@ -75,7 +291,32 @@ class DocManager(DocManagerBase):
     def update(self, doc, update_spec):
         """Apply updates given in update_spec to the document whose id
         matches that of doc.
+
+        If ``partial_updates`` is enabled, ``$set`` and ``$unset`` updates are
+        applied by Elasticsearch together with the metadata in a single bulk
+        request, and None is returned instead of the updated document.
         """
+        if "$set" not in update_spec and "$unset" not in update_spec:
+            # The update spec is the whole new document, so there is no need
+            # to read the current one
+            updated = dict(update_spec)
+            updated['_id'] = doc['_id']
+            updated['ns'] = doc['ns']
+            updated['_ts'] = doc['_ts']
+            self.upsert(updated)
+            return updated
+
+        if self.partial_updates:
+            try:
+                self._partial_update(doc, update_spec)
+                return None
+            except errors.OperationFailed:
+                # Scripts may be disabled in Elasticsearch, or the update
+                # may not apply to the document
+                logging.exception("Could not apply partial update %r to "
+                                  "document %r, reindexing the whole "
+                                  "document instead", update_spec, doc)
+
         document = self.elastic.get(index=doc['ns'],
                                     id=str(doc['_id']))
         updated = self.apply_update(document['_source'], update_spec)
@@ -90,10 +331,251 @@ class DocManager(DocManagerBase):
         # upsert() strips metadata, so only _id + fields in _source still here
         return updated
 
+    def _partial_update(self, doc, update_spec):
+        """Apply a $set and $unset update spec to a document in Elasticsearch,
+        and update the document's metadata, in one bulk request.
+        """
+        doc_id = str(doc['_id'])
+        to_set = self._formatter.format_document(update_spec.get("$set", {}))
+        to_unset = list(update_spec.get("$unset", {}))
+        if self.inline_metadata:
+            to_set["ns"] = doc['ns']
+            to_set["_ts"] = doc['_ts']
+        if (not to_unset and
+                not any('.' in k or isinstance(v, dict)
+                        for k, v in to_set.items())):
+            # Merging top-level fields that aren't documents has the same
+            # effect as $set. Documents would be merged recursively.
+            update = {"doc": to_set}
+        else:
+            update = {
+                "script": UPDATE_SCRIPT,
+                "lang": "groovy",
+                "params": {
+                    "sets": [[k.split("."), v] for k, v in to_set.items()],
+                    "unsets": [k.split(".") for k in to_unset]
+                }
+            }
+        actions = [({"update": {"_index": doc['ns'], "_type": self.doc_type,
+                                "_id": doc_id}},
+                    update)]
+        if not self.inline_metadata:
+            actions.append(
+                ({"index": {"_index": self.meta_index_name,
+                            "_type": self.meta_type, "_id": doc_id}},
+                 {"ns": doc['ns'], "_ts": doc['_ts']}))
+        # update() reindexes the document if this fails, so the actions
+        # aren't dropped yet
+        self._send_bulk(actions, report_failures=False)
+
+    @wrap_exceptions
+    def _send_bulk(self, actions, report_failures=True):
+        """Send a list of (action, source) pairs in one bulk request.
+
+        ``source`` is None for delete actions. Raises OperationFailed if any
+        action fails, except for deleting a document that doesn't exist.
+        """
+        refresh = (self.auto_commit_interval == 0)
+        if not refresh:
+            self._mark_dirty(header["_index"] for action, _ in actions
+                             for header in action.values())
+        failures = self._send_with_retries(actions, refresh=refresh,
+                                           report_failures=report_failures)
+        if failures:
+            raise errors.OperationFailed(
+                "Elasticsearch bulk request failed: %r"
+                % [result for _, _, result in failures])
+
+    def _bulk(self, body, refresh):
+        """Send one bulk request and return the response."""
+        BULK_IN_FLIGHT.inc(target=self.metrics_target)
+        try:
+            return self.elastic.bulk(body=body, refresh=refresh)
+        finally:
+            BULK_IN_FLIGHT.inc(-1, target=self.metrics_target)
+
+    def _send_with_retries(self, actions, refresh=False,
+                           report_failures=True):
+        """Send a list of (action, source) pairs in one bulk request, and
+        resend the actions that fail with a status in RETRY_STATUSES.
+
+        Only the failing actions are resent, up to ``max_retries`` times with
+        exponential backoff. Returns a list of (action, source, result) for
+        the actions that failed. Unless ``report_failures`` is False, they
+        are also counted as dropped and passed to ``bulk_failure_callback``.
+        """
+        pending = list(actions)
+        failures = []
+        backoff = self.retry_backoff
+        attempt = 0
+        while pending:
+            body = []
+            for action, source in pending:
+                body.append(action)
+                if source is not None:
+                    body.append(source)
+            retry = []
+            try:
+                response = self._bulk(body, refresh)
+            except es_exceptions.TransportError as exc:
+                # ConnectionError is a TransportError without a status
+                if attempt >= self.max_retries or not (
+                        isinstance(exc, es_exceptions.ConnectionError) or
+                        exc.status_code in RETRY_STATUSES):
+                    raise
+                logging.warning("Elasticsearch bulk request failed, "
+                                "resending %d actions: %s", len(pending), exc)
+                retry = pending
+            else:
+                for pair, item in zip(pending, response.get("items", [])):
+                    for op_type, result in item.items():
+                        status = result.get("status", 200)
+                        # Removing a document that doesn't exist is not an
+                        # error
+                        if status < 300 or (op_type == "delete" and
+                                            status == 404):
+                            continue
+                        BULK_ITEMS.inc(outcome="rejected")
+                        if (status in RETRY_STATUSES and
+                                attempt < self.max_retries):
+                            retry.append(pair)
+                        else:
+                            failures.append((pair[0], pair[1], result))
+                if retry:
+                    logging.warning("Elasticsearch rejected %d of %d bulk "
+                                    "actions, resending them",
+                                    len(retry), len(pending))
+            if retry:
+                BULK_ITEMS.inc(len(retry), outcome="retried")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, DEFAULT_MAX_BACKOFF)
+                attempt += 1
+            pending = retry
+        if failures and report_failures:
+            BULK_ITEMS.inc(len(failures), outcome="dropped")
+            if self.bulk_failure_callback is not None:
+                try:
+                    self.bulk_failure_callback(failures)
+                except Exception:
+                    logging.exception("Error in bulk_failure_callback")
+        return failures
+
+    def _index_name(self, namespace):
+        """Return the index that documents from a namespace are written to.
+        """
+        return self._load_indices.get(namespace, namespace)
+
+    @wrap_exceptions
+    def begin_bulk_load(self, namespaces):
+        """Prepare the indices of a collection dump for bulk loading.
+
+        If ``bulk_load_alias`` is set, each index that doesn't exist yet or
+        is an alias is replaced by a new index. If ``bulk_load`` is set, the
+        indices are not refreshed and have no replicas during the load.
+        """
+        if not (self.bulk_load or self.bulk_load_alias):
+            return
+        with self._dirty_lock:
+            self._bulk_loads += 1
+        for namespace in namespaces:
+            index = namespace
+            if self.bulk_load_alias:
+                index = self._new_load_index(namespace)
+                self._load_indices[namespace] = index
+            elif not self.elastic.indices.exists(index=index):
+                self.elastic.indices.create(index=index)
+            if not self.bulk_load:
+                continue
+            settings = self.elastic.indices.get_settings(
+                index=index, flat_settings=True)
+            original = list(settings.values())[0]["settings"]
+            if original.get("index.refresh_interval") == "-1":
+                # Left by a bulk load that didn't finish. Its original
+                # settings are lost, so restore the defaults afterwards.
+                logging.warning("Elastic DocManager: index %s is still set "
+                                "up for bulk loading, restoring the default "
+                                "settings after the load", index)
+                original = {}
+            self._load_settings[index] = {
+                "refresh_interval": original.get(
+                    "index.refresh_interval", "1s"),
+                "number_of_replicas": original.get(
+                    "index.number_of_replicas", 1)}
+            self.elastic.indices.put_settings(
+                index=index,
+                body={"index": {"refresh_interval": "-1",
+                                "number_of_replicas": 0}})
+            logging.info("Elastic DocManager: bulk loading index %s", index)
+
+    def _new_load_index(self, namespace):
+        """Return the index to load the documents of a namespace into when
+        ``bulk_load_alias`` is set, creating it if needed.
+
+        An index left by a dump that didn't finish is reused, since the dump
+        resumes where it left off.
+        """
+        if (self.elastic.indices.exists(index=namespace) and
+                not self.elastic.indices.exists_alias(name=namespace)):
+            logging.warning("Elastic DocManager: %s is an index rather than "
+                            "an alias, bulk loading it in place", namespace)
+            return namespace
+        aliased = self._aliased_indices(namespace)
+        pattern = "%s-bulk-*" % namespace
+        existing = self.elastic.indices.get_settings(index=pattern)
+        for index in sorted(existing):
+            if index not in aliased:
+                return index
+        index = "%s-bulk-%d" % (namespace, int(time.time() * 1000))
+        self.elastic.indices.create(index=index)
+        return index
+
+    def _aliased_indices(self, alias):
+        """Return the list of indices that an alias points to."""
+        if not self.elastic.indices.exists_alias(name=alias):
+            return []
+        return list(self.elastic.indices.get_alias(name=alias))
+
+    @wrap_exceptions
+    def end_bulk_load(self, namespaces, success):
+        """Restore the settings of the indices of a collection dump and
+        refresh them. If ``bulk_load_alias`` is set and the dump succeeded,
+        point the alias for each namespace to its new index.
+        """
+        if not (self.bulk_load or self.bulk_load_alias):
+            return
+        try:
+            for namespace in namespaces:
+                index = self._index_name(namespace)
+                settings = self._load_settings.pop(index, None)
+                if settings is not None:
+                    self.elastic.indices.put_settings(
+                        index=index, body={"index": settings})
+                self.elastic.indices.refresh(index=index,
+                                             ignore_unavailable=True)
+                if not success or index == namespace:
+                    continue
+                old_indices = self._aliased_indices(namespace)
+                actions = [{"remove": {"index": old, "alias": namespace}}
+                           for old in old_indices]
+                actions.append({"add": {"index": index, "alias": namespace}})
+                self.elastic.indices.update_aliases(body={"actions": actions})
+                logging.info("Elastic DocManager: alias %s now points to "
+                             "index %s", namespace, index)
+                for old in old_indices:
+                    if old != index:
+                        self.elastic.indices.delete(index=old)
+        finally:
+            for namespace in namespaces:
+                self._load_indices.pop(namespace, None)
+            with self._dirty_lock:
+                self._bulk_loads -= 1
+
     @wrap_exceptions
     def upsert(self, doc):
-        """Insert a document into Elasticsearch."""
-        doc_type = self.doc_type
+        """Insert a document into Elasticsearch.
+
+        The document and its metadata are indexed in one bulk request.
+        """
         index = doc.pop('ns')
         # No need to duplicate '_id' in source document
         doc_id = str(doc.pop("_id"))
@@ -101,14 +583,21 @@ class DocManager(DocManagerBase):
             "ns": index,
             "_ts": doc.pop("_ts")
         }
+        source = self._formatter.format_document(doc)
         # Index the source document
-        self.elastic.index(index=index, doc_type=doc_type,
-                           body=self._formatter.format_document(doc), id=doc_id,
-                           refresh=(self.auto_commit_interval == 0))
-        # Index document metadata
-        self.elastic.index(index=self.meta_index_name, doc_type=self.meta_type,
-                           body=bson.json_util.dumps(metadata), id=doc_id,
-                           refresh=(self.auto_commit_interval == 0))
+        actions = [({"index": {"_index": self._index_name(index),
+                               "_type": self.doc_type,
+                               "_id": doc_id}},
+                    source)]
+        if self.inline_metadata:
+            source.update(metadata)
+        else:
+            # Index document metadata
+            actions.append(({"index": {"_index": self.meta_index_name,
+                                       "_type": self.meta_type,
+                                       "_id": doc_id}},
+                            metadata))
+        self._send_bulk(actions)
         # Leave _id, since it's part of the original document
         doc['_id'] = doc_id
 
@@ -116,14 +605,15 @@ class DocManager(DocManagerBase):
     def bulk_upsert(self, docs):
         """Insert multiple documents into Elasticsearch."""
         def docs_to_upsert():
-            doc = None
+            count = 0
             for doc in docs:
+                count += 1
                 # Remove metadata and redundant _id
                 index = doc.pop("ns")
                 doc_id = str(doc.pop("_id"))
                 timestamp = doc.pop("_ts")
                 document_action = {
-                    "_index": index,
+                    "_index": self._index_name(index),
                     "_type": self.doc_type,
                     "_id": doc_id,
                     "_source": self._formatter.format_document(doc)
@@ -133,32 +623,23 @@ class DocManager(DocManagerBase):
                     "_type": self.meta_type,
                     "_id": doc_id,
                     "_source": {
-                        "_ns": index,
-                        "ts": timestamp
+                        "ns": index,
+                        "_ts": timestamp
                     }
                 }
-                yield document_action
-                yield document_meta
-            if not doc:
+                if self.inline_metadata:
+                    document_action["_source"].update(
+                        document_meta["_source"])
+                    yield document_action
+                else:
+                    yield document_action
+                    yield document_meta
+            if not count:
                 raise errors.EmptyDocsError(
                     "Cannot upsert an empty sequence of "
                     "documents into Elastic Search")
         try:
-            kw = {}
-            if self.chunk_size > 0:
-                kw['chunk_size'] = self.chunk_size
-
-            responses = streaming_bulk(client=self.elastic,
-                                       actions=docs_to_upsert(),
-                                       **kw)
-
-            for ok, resp in responses:
-                if not ok:
-                    logging.error(
-                        "Could not bulk-upsert document "
-                        "into ElasticSearch: %r" % resp)
-            if self.auto_commit_interval == 0:
-                self.commit()
+            self._streaming_bulk(docs_to_upsert())
         except errors.EmptyDocsError:
             # This can happen when mongo-connector starts up, there is no
             # config file, but nothing to dump
@@ -166,13 +647,92 @@ class DocManager(DocManagerBase):
 
     @wrap_exceptions
     def remove(self, doc):
-        """Remove a document from Elasticsearch."""
-        self.elastic.delete(index=doc['ns'], doc_type=self.doc_type,
-                            id=str(doc["_id"]),
-                            refresh=(self.auto_commit_interval == 0))
-        self.elastic.delete(index=self.meta_index_name, doc_type=self.meta_type,
-                            id=str(doc["_id"]),
-                            refresh=(self.auto_commit_interval == 0))
+        """Remove a document from Elasticsearch.
+
+        The document and its metadata are deleted in one bulk request.
+        """
+        doc_id = str(doc["_id"])
+        actions = [({"delete": {"_index": doc['ns'], "_type": self.doc_type,
+                                "_id": doc_id}}, None)]
+        if not self.inline_metadata:
+            actions.append(({"delete": {"_index": self.meta_index_name,
+                                        "_type": self.meta_type,
+                                        "_id": doc_id}}, None))
+        self._send_bulk(actions)
+
+    @wrap_exceptions
+    def bulk_remove(self, docs):
+        """Remove multiple documents from Elasticsearch."""
+        def docs_to_remove():
+            for doc in docs:
+                doc_id = str(doc["_id"])
+                yield {"_op_type": "delete",
+                       "_index": doc['ns'],
+                       "_type": self.doc_type,
+                       "_id": doc_id}
+                if self.inline_metadata:
+                    continue
+                yield {"_op_type": "delete",
+                       "_index": self.meta_index_name,
+                       "_type": self.meta_type,
+                       "_id": doc_id}
+
+        self._streaming_bulk(docs_to_remove())
+
+    def _streaming_bulk(self, actions):
+        """Send actions to Elasticsearch in bulk requests of at most
+        ``chunk_size`` actions.
+
+        Rejected actions are resent as described in ``_send_with_retries``.
+        If ``bulk_senders`` is greater than 1, the requests are sent
+        concurrently by the sender threads. Returns once every request has
+        been sent. Raises OperationFailed if any action failed, except for
+        deleting a document that doesn't exist.
+        """
+        chunk_size = DEFAULT_MAX_BULK
+        if self.chunk_size > 0:
+            chunk_size = self.chunk_size
+        indices = set()
+        failures = []
+        senders = len(self._senders)
+        batch = _BulkBatch()
+
+        def send(lane, chunk):
+            if senders:
+                self._enqueue_chunk(lane, chunk, batch)
+            else:
+                failures.extend(self._send_with_retries(chunk))
+
+        with self._dirty_lock:
+            self._bulk_requests += 1
+        try:
+            # One chunk per sender, or a single chunk sent from this thread
+            chunks = [[] for i in range(max(1, senders))]
+            for action in actions:
+                indices.add(action["_index"])
+                lane = hash(action["_id"]) % senders if senders else 0
+                chunks[lane].append(expand_action(action))
+                if len(chunks[lane]) >= chunk_size:
+                    send(lane, chunks[lane])
+                    chunks[lane] = []
+            for lane, chunk in enumerate(chunks):
+                if chunk:
+                    send(lane, chunk)
+        finally:
+            # Wait for the senders even if the actions couldn't all be read
+            batch.wait()
+            with self._dirty_lock:
+                self._bulk_requests -= 1
+                self._dirty_indices.update(indices)
+        if batch.exc_info is not None:
+            reraise(*batch.exc_info)
+        failures.extend(batch.failures)
+        if self.auto_commit_interval == 0:
+            self.commit()
+        if failures:
+            raise errors.OperationFailed(
+                "Elasticsearch bulk request failed for %d actions: %r"
+                % (len(failures), [result for _, _, result in failures]))
 
     @wrap_exceptions
     def _stream_search(self, *args, **kwargs):
@@ -182,15 +742,22 @@ class DocManager(DocManagerBase):
             hit['_source']['_id'] = hit['_id']
             yield hit['_source']
 
-    def search(self, start_ts, end_ts):
-        """Query Elasticsearch for documents in a time range.
+    def _metadata_index(self):
+        """Return the indices holding the metadata of documents."""
+        if self.inline_metadata:
+            return self.index_pattern
+        return self.meta_index_name
 
-        This method is used to find documents that may be in conflict during
-        a rollback event in MongoDB.
+    def _search_range(self, start_ts, end_ts):
+        """Iterate over the metadata of documents with a _ts between
+        start_ts and end_ts, inclusive.
         """
         return self._stream_search(
-            index=self.meta_index_name,
+            index=self._metadata_index(),
+            size=self.search_page_size,
             body={
+                # Rollbacks only need the _id and metadata
+                "_source": ["ns", "_ts"],
                 "query": {
                     "filtered": {
                         "filter": {
@@ -202,15 +769,117 @@ class DocManager(DocManagerBase):
                 }
             })
 
+    def search(self, start_ts, end_ts):
+        """Query Elasticsearch for documents in a time range.
+
+        This method is used to find documents that may be in conflict during
+        a rollback event in MongoDB.
+
+        The time range is split into ``search_slices`` equal parts that are
+        scanned concurrently. Documents are returned in no particular order.
+        """
+        slices = max(1, min(self.search_slices, end_ts - start_ts + 1))
+        if slices == 1:
+            return self._search_range(start_ts, end_ts)
+        step = (end_ts - start_ts + 1) // slices
+        ranges = []
+        for i in range(slices):
+            low = start_ts + i * step
+            high = end_ts if i == slices - 1 else low + step - 1
+            ranges.append((low, high))
+        return self._parallel_search(ranges)
+
+    def _parallel_search(self, ranges):
+        """Scan several ranges of _ts from their own threads, and yield the
+        documents found through a queue of at most ``search_buffer_size``
+        documents.
+        """
+        results = queue.Queue(maxsize=max(1, self.search_buffer_size))
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        def scan_range(start_ts, end_ts):
+            try:
+                for doc in self._search_range(start_ts, end_ts):
+                    if stop.is_set():
+                        return
+                    put(doc)
+            except Exception as exc:
+                put(exc)
+            finally:
+                put(done)
+
+        threads = [threading.Thread(target=scan_range, args=r)
+                   for r in ranges]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            remaining = len(threads)
+            while remaining:
+                item = results.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # Let the threads exit if iteration is abandoned
+            stop.set()
+
     def commit(self):
-        """Refresh all Elasticsearch indexes."""
-        retry_until_ok(self.elastic.indices.refresh, index="")
+        """Refresh the Elasticsearch indexes written to since they were last
+        refreshed.
+        """
+        with self._dirty_lock:
+            indices = self._dirty_indices
+            self._dirty_indices = set()
+        if not indices:
+            return
+        retry_until_ok(self.elastic.indices.refresh,
+                       index=",".join(sorted(indices)),
+                       ignore_unavailable=True)
 
     def run_auto_commit(self):
-        """Periodically commit to the Elastic server."""
-        self.elastic.indices.refresh()
-        if self.auto_commit_interval not in [None, 0]:
-            Timer(self.auto_commit_interval, self.run_auto_commit).start()
+        """Periodically commit to the Elastic server from a daemon thread.
+
+        Commits are skipped while bulk loads are in progress, since the
+        refreshes would only slow them down. A commit is put off by one
+        interval while bulk requests are being sent, so that a steady stream
+        of them doesn't keep the indices from being refreshed.
+        """
+        def auto_commit():
+            deferred = False
+            while self.auto_commit_interval not in [None, 0]:
+                self._auto_commit_stop.wait(self.auto_commit_interval)
+                if self._auto_commit_stop.is_set():
+                    return
+                with self._dirty_lock:
+                    loading = self._bulk_loads > 0
+                    sending = self._bulk_requests > 0
+                if loading:
+                    continue
+                if sending and not deferred:
+                    deferred = True
+                    continue
+                deferred = False
+                try:
+                    self.commit()
+                except Exception:
+                    logging.exception("Could not refresh Elasticsearch "
+                                      "indexes")
+        thread = threading.Thread(target=auto_commit)
+        thread.daemon = True
+        thread.start()
 
     @wrap_exceptions
     def get_last_doc(self):
@@ -221,10 +890,14 @@ class DocManager(DocManagerBase):
         """
         try:
             result = self.elastic.search(
-                index=self.meta_index_name,
+                index=self._metadata_index(),
                 body={
+                    "_source": ["ns", "_ts"],
                     "query": {"match_all": {}},
-                    "sort": [{"_ts": "desc"}],
+                    # Indices without documents from MongoDB may match the
+                    # index pattern
+                    "sort": [{"_ts": {"order": "desc",
+                                      "ignore_unmapped": True}}],
                 },
                 size=1
             )["hits"]["hits"]
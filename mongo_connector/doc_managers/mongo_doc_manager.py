@@ -21,16 +21,24 @@
     replace the method definitions with API calls for the desired backend.
     """
 
+import itertools
 import logging
 import pymongo
 
+from pymongo.collection import Collection
+
 from mongo_connector import errors
+from mongo_connector.constants import DEFAULT_MAX_BULK
 from mongo_connector.doc_managers import DocManagerBase, exception_wrapper
 
 
-wrap_exceptions = exception_wrapper({
+exception_mapping = {
     pymongo.errors.ConnectionFailure: errors.ConnectionFailed,
-    pymongo.errors.OperationFailure: errors.OperationFailed})
+    pymongo.errors.OperationFailure: errors.OperationFailed}
+# Bulk write operations were added in PyMongo 2.7
+if hasattr(pymongo.errors, 'BulkWriteError'):
+    exception_mapping[pymongo.errors.BulkWriteError] = errors.OperationFailed
+wrap_exceptions = exception_wrapper(exception_mapping)
 
 
 class DocManager(DocManagerBase):
@@ -45,7 +53,8 @@ class DocManager(DocManagerBase):
         them as fields in the document, due to compatibility issues.
         """
 
-    def __init__(self, url, **kwargs):
+    def __init__(self, url, write_concern=None, chunk_size=DEFAULT_MAX_BULK,
+                 **kwargs):
         """ Verify URL and establish a connection.
         """
         try:
@@ -55,6 +64,11 @@ class DocManager(DocManagerBase):
         except pymongo.errors.ConnectionFailure:
             raise errors.ConnectionFailed("Failed to connect to MongoDB")
         self.namespace_set = kwargs.get("namespace_set")
+        # Write concern of all writes, such as {"w": "majority"}
+        self.write_concern = write_concern or {}
+        # Maximum # of documents written by bulk_upsert and bulk_remove in
+        # each round of bulk write operations
+        self.chunk_size = chunk_size
         for namespace in self._namespaces():
             self.mongo["__mongo_connector"][namespace].create_index("_ts")
 
@@ -113,8 +127,61 @@ class DocManager(DocManagerBase):
             '_id': doc['_id'],
             "_ts": ts,
             "ns": ns
-        })
-        self.mongo[database][coll].save(doc)
+        }, **self.write_concern)
+        self.mongo[database][coll].save(doc, **self.write_concern)
+
+    def _chunks_by_namespace(self, docs):
+        """Split documents into chunks of at most ``chunk_size`` documents,
+        and yield each chunk as a dictionary of namespace to documents.
+        """
+        docs = iter(docs)
+        while True:
+            if self.chunk_size > 0:
+                chunk = list(itertools.islice(docs, self.chunk_size))
+            else:
+                chunk = list(docs)
+            if not chunk:
+                return
+            by_namespace = {}
+            for doc in chunk:
+                by_namespace.setdefault(doc['ns'], []).append(doc)
+            yield by_namespace
+
+    def _bulk_supported(self):
+        """Return True if PyMongo supports bulk write operations."""
+        return hasattr(Collection, 'initialize_unordered_bulk_op')
+
+    @wrap_exceptions
+    def bulk_upsert(self, docs):
+        """Update or insert multiple documents into Mongo
+
+        Documents are replaced with unordered bulk write operations, one per
+        namespace in each chunk of ``chunk_size`` documents, and so are
+        their metadata. The documents should have distinct ids, as they do
+        when they come from a collection dump or from consecutive inserts.
+        """
+        if not self._bulk_supported():
+            return super(DocManager, self).bulk_upsert(docs)
+        for by_namespace in self._chunks_by_namespace(docs):
+            for ns, ns_docs in by_namespace.items():
+                database, coll = ns.split('.', 1)
+                meta = self.mongo["__mongo_connector"][
+                    ns].initialize_unordered_bulk_op()
+                bulk = self.mongo[database][
+                    coll].initialize_unordered_bulk_op()
+                for doc in ns_docs:
+                    # Leave the caller's document intact
+                    doc = dict(doc)
+                    ts = doc.pop("_ts")
+                    doc.pop("ns")
+                    meta.find({'_id': doc['_id']}).upsert().replace_one({
+                        '_id': doc['_id'],
+                        "_ts": ts,
+                        "ns": ns
+                    })
+                    bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+                meta.execute(self.write_concern or None)
+                bulk.execute(self.write_concern or None)
 
     @wrap_exceptions
     def remove(self, doc):
@@ -124,8 +191,33 @@ class DocManager(DocManagerBase):
         The documents has ns and _ts fields.
         """
         database, coll = doc['ns'].split('.', 1)
-        self.mongo[database][coll].remove({'_id': doc["_id"]})
-        self.mongo["__mongo_connector"][doc['ns']].remove({'_id': doc["_id"]})
+        self.mongo[database][coll].remove({'_id': doc["_id"]},
+                                          **self.write_concern)
+        self.mongo["__mongo_connector"][doc['ns']].remove(
+            {'_id': doc["_id"]}, **self.write_concern)
+
+    @wrap_exceptions
+    def bulk_remove(self, docs):
+        """Remove multiple documents from Mongo
+
+        Documents and their metadata are removed with unordered bulk write
+        operations, one per namespace in each chunk of ``chunk_size``
+        documents.
+        """
+        if not self._bulk_supported():
+            return super(DocManager, self).bulk_remove(docs)
+        for by_namespace in self._chunks_by_namespace(docs):
+            for ns, ns_docs in by_namespace.items():
+                database, coll = ns.split('.', 1)
+                bulk = self.mongo[database][
+                    coll].initialize_unordered_bulk_op()
+                meta = self.mongo["__mongo_connector"][
+                    ns].initialize_unordered_bulk_op()
+                for doc in ns_docs:
+                    bulk.find({'_id': doc['_id']}).remove_one()
+                    meta.find({'_id': doc['_id']}).remove_one()
+                bulk.execute(self.write_concern or None)
+                meta.execute(self.write_concern or None)
 
     @wrap_exceptions
     def search(self, start_ts, end_ts):
@@ -20,14 +20,26 @@ is that this file can be used as an example to add on different backends.
 To extend this to other systems, simply implement the exact same class and
 replace the method definitions with API calls for the desired backend.
 """
-import re
+import itertools
+import logging
 import json
-
-from pysolr import Solr, SolrError
-
-from mongo_connector import errors
-from mongo_connector.constants import (DEFAULT_COMMIT_INTERVAL,
-                                       DEFAULT_MAX_BULK)
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import sys
+import threading
+import time
+
+from pysolr import Solr, SolrError, safe_urlencode
+
+from mongo_connector import errors, metrics
+from mongo_connector.compat import reraise
+from mongo_connector.constants import (DEFAULT_BULK_QUEUE_SIZE,
+                                       DEFAULT_BULK_SENDERS,
+                                       DEFAULT_COMMIT_INTERVAL,
+                                       DEFAULT_MAX_BULK,
+                                       DEFAULT_SEARCH_PAGE_SIZE)
 from mongo_connector.util import retry_until_ok
 from mongo_connector.doc_managers import DocManagerBase, exception_wrapper
 from mongo_connector.doc_managers.formatters import DocumentFlattener
@@ -41,6 +53,70 @@ ADMIN_URL = 'admin/luke?show=schema&wt=json'
 
 decoder = json.JSONDecoder()
 
+BULK_LATENCY = metrics.REGISTRY.register(metrics.Histogram(
+    "mongo_connector_solr_bulk_chunk_seconds",
+    "Seconds taken to clean, serialize and post each chunk of documents "
+    "upserted in bulk into Solr.", ["stage"]))
+
+
+class FieldMatcher(object):
+    """Decides which fields of a flattened document are in a Solr schema.
+
+    Static field names are kept in a set. Dynamic field names have exactly
+    one wildcard, either at the beginning or the end of the name, so they
+    are matched with a single ``endswith`` or ``startswith`` call over all
+    suffixes or prefixes. Decisions are memoized for up to ``memo_size``
+    field names, after which the memo is cleared.
+
+    A FieldMatcher without any fields matches every field, since the
+    schema couldn't be retrieved.
+    """
+
+    def __init__(self, fields=(), dynamic_fields=(), memo_size=10000):
+        self.fields = frozenset(fields)
+        self.dynamic_fields = tuple(dynamic_fields)
+        self.prefixes = tuple(p[:-1] for p in self.dynamic_fields
+                              if p.endswith("*"))
+        self.suffixes = tuple(p[1:] for p in self.dynamic_fields
+                              if p.startswith("*"))
+        self.memo_size = memo_size
+        self._memo = {}
+
+    def __bool__(self):
+        return bool(self.fields or self.prefixes or self.suffixes)
+    __nonzero__ = __bool__
+
+    def matches(self, field):
+        """Return True if ``field`` is a field or dynamic field of the
+        schema.
+        """
+        try:
+            return self._memo[field]
+        except KeyError:
+            pass
+        result = (not self or field in self.fields or
+                  field.startswith(self.prefixes) or
+                  field.endswith(self.suffixes))
+        if len(self._memo) >= self.memo_size:
+            self._memo = {}
+        self._memo[field] = result
+        return result
+
+    def may_have_subfields(self, field):
+        """Return True if the schema declares fields for the contents of a
+        document or array stored at ``field``, such as ``field.0``.
+
+        Dynamic fields with a leading wildcard, such as ``*_i``, are not
+        considered, since they would make every field a candidate.
+        """
+        if not self:
+            return True
+        prefix = field + "."
+        if any(f.startswith(prefix) for f in self.fields):
+            return True
+        return any(p.startswith(prefix) or prefix.startswith(p)
+                   for p in self.prefixes)
+
 
 class DocManager(DocManagerBase):
     """The DocManager class creates a connection to the backend engine and
@@ -52,7 +128,11 @@ class DocManager(DocManagerBase):
     """
 
     def __init__(self, url, auto_commit_interval=DEFAULT_COMMIT_INTERVAL,
-                 unique_key='_id', chunk_size=DEFAULT_MAX_BULK, **kwargs):
+                 unique_key='_id', chunk_size=DEFAULT_MAX_BULK,
+                 atomic_updates=False, schema_refresh_interval=None,
+                 bulk_senders=DEFAULT_BULK_SENDERS,
+                 bulk_queue_size=DEFAULT_BULK_QUEUE_SIZE,
+                 search_page_size=DEFAULT_SEARCH_PAGE_SIZE, **kwargs):
         """Verify Solr URL and establish a connection.
         """
         self.solr = Solr(url)
@@ -63,9 +143,27 @@ class DocManager(DocManagerBase):
         else:
             self.auto_commit_interval = None
         self.chunk_size = chunk_size
+        # Apply $set and $unset with atomic updates in Solr when possible,
+        # rather than reading and adding the whole document again. This
+        # requires all fields to be stored and the update log to be enabled.
+        self.atomic_updates = atomic_updates
+        # Number of update requests that bulk_upsert keeps in flight, and
+        # the maximum # of cleaned chunks waiting to be sent
+        self.bulk_senders = bulk_senders
+        self.bulk_queue_size = bulk_queue_size
+        # Number of documents fetched per request when paging through
+        # search results
+        self.search_page_size = search_page_size
         self.field_list = []
+        self._field_matcher = FieldMatcher()
         self._build_fields()
         self._formatter = DocumentFlattener()
+        # Number of seconds between reloads of the schema, or None to only
+        # load it once
+        self.schema_refresh_interval = schema_refresh_interval
+        self._schema_refresh_stop = threading.Event()
+        if self.schema_refresh_interval:
+            self.run_schema_refresh()
 
     def _parse_fields(self, result, field_name):
         """ If Schema access, parse fields and build respective lists
@@ -83,18 +181,27 @@ class DocManager(DocManagerBase):
         declared_fields = self.solr._send_request('get', ADMIN_URL)
         result = decoder.decode(declared_fields)
         self.field_list = self._parse_fields(result, 'fields')
-
-        # Build regular expressions to match dynamic fields.
-        # dynamic field names may have exactly one wildcard, either at
-        # the beginning or the end of the name
-        self._dynamic_field_regexes = []
-        for wc_pattern in self._parse_fields(result, 'dynamicFields'):
-            if wc_pattern[0] == "*":
-                self._dynamic_field_regexes.append(
-                    re.compile(".*%s\Z" % wc_pattern[1:]))
-            elif wc_pattern[-1] == "*":
-                self._dynamic_field_regexes.append(
-                    re.compile("\A%s.*" % wc_pattern[:-1]))
+        # Replace the matcher at once, since it may be in use by other
+        # threads
+        self._field_matcher = FieldMatcher(
+            self.field_list, self._parse_fields(result, 'dynamicFields'))
+
+    def run_schema_refresh(self):
+        """Periodically reload the fields of the schema from a daemon
+        thread.
+        """
+        def refresh():
+            while True:
+                self._schema_refresh_stop.wait(self.schema_refresh_interval)
+                if self._schema_refresh_stop.is_set():
+                    return
+                try:
+                    self._build_fields()
+                except Exception:
+                    logging.exception("Could not reload the Solr schema")
+        thread = threading.Thread(target=refresh)
+        thread.daemon = True
+        thread.start()
 
     def _clean_doc(self, doc):
         """Reformats the given document before insertion into Solr.
@@ -133,18 +240,16 @@ class DocManager(DocManagerBase):
         # Only include fields that are explicitly provided in the
         # schema or match one of the dynamic field patterns, if
         # we were able to retrieve the schema
-        if len(self.field_list) + len(self._dynamic_field_regexes) > 0:
-            def include_field(field):
-                return field in self.field_list or any(
-                    regex.match(field) for regex in self._dynamic_field_regexes
-                )
-            return dict((k, v) for k, v in flat_doc.items() if include_field(k))
+        matcher = self._field_matcher
+        if matcher:
+            return dict((k, v) for k, v in flat_doc.items()
+                        if matcher.matches(k))
         return flat_doc
 
     def stop(self):
         """ Stops the instance
         """
-        pass
+        self._schema_refresh_stop.set()
 
     def apply_update(self, doc, update_spec):
         """Override DocManagerBase.apply_update to have flat documents."""
@@ -170,26 +275,119 @@ class DocManager(DocManagerBase):
             doc.pop(to_unset)
         return doc
 
+    def _commit_params(self):
+        """Return the query string for update requests, which has Solr
+        commit according to ``auto_commit_interval``.
+        """
+        if self.auto_commit_interval is None:
+            return "commit=false"
+        elif self.auto_commit_interval == 0:
+            return "commit=true"
+        return "commit=false&commitWithin=%d" % self.auto_commit_interval
+
+    def _to_solr(self, value):
+        """Convert a value of a flattened document for Solr's JSON update
+        format.
+        """
+        if value is None:
+            return None
+        return self.solr._from_python(value)
+
+    def _atomic_update(self, doc, update_spec):
+        """Apply a $set and $unset update spec to a document with a Solr
+        atomic update, along with the document's metadata.
+
+        Documents that don't exist are skipped. Returns False without
+        updating the document if the update can't be expressed as an atomic
+        update. That's the case when a document or array is set, and when
+        the schema declares subfields of a field set or unset, since the
+        subfields to remove are unknown without reading the document. Other
+        fields are assumed not to hold documents or arrays.
+        """
+        to_set = update_spec.get("$set", {})
+        to_unset = list(update_spec.get("$unset", {}))
+        for key in list(to_set) + to_unset:
+            if self._field_matcher.may_have_subfields(key):
+                return False
+        if any(isinstance(v, (dict, list)) for v in to_set.values()):
+            return False
+
+        fields = self._formatter.format_document(to_set)
+        for key in to_unset:
+            fields[key] = None
+        fields["ns"] = doc["ns"]
+        fields["_ts"] = doc["_ts"]
+        update = dict((key, {"set": self._to_solr(value)})
+                      for key, value in fields.items()
+                      if self._field_matcher.matches(key))
+        update[self.unique_key] = self._to_solr(
+            self._formatter.transform_value(doc["_id"]))
+        # A _version_ of 1 only applies the update if the document exists,
+        # rather than creating a document with only the updated fields
+        update["_version_"] = 1
+        try:
+            self.solr._send_request(
+                'post', 'update/json?' + self._commit_params(),
+                body=json.dumps([update]),
+                headers={'Content-type': 'application/json'})
+        except SolrError as exc:
+            if "(HTTP 409)" not in str(exc):
+                raise
+            # Version conflict: the document doesn't exist, so there is
+            # nothing to update
+            logging.debug("Solr DocManager: skipping atomic update of "
+                          "missing document %r", doc["_id"])
+        return True
+
     @wrap_exceptions
     def update(self, doc, update_spec):
         """Apply updates given in update_spec to the document whose id
         matches that of doc.
 
+        If ``atomic_updates`` is enabled, ``$set`` and ``$unset`` updates that
+        can be expressed as Solr atomic updates are sent without reading the
+        document, and None is returned instead of the updated document.
         """
-        query = "%s:%s" % (self.unique_key, str(doc['_id']))
-        results = self.solr.search(query)
-        if not len(results):
-            # Document may not be retrievable yet
-            self.commit()
-            results = self.solr.search(query)
-        # Results is an iterable containing only 1 result
-        for doc in results:
+        if (self.atomic_updates and
+                ("$set" in update_spec or "$unset" in update_spec)):
+            try:
+                if self._atomic_update(doc, update_spec):
+                    return None
+            except SolrError:
+                logging.exception("Could not apply atomic update %r to "
+                                  "document %r, reindexing the whole "
+                                  "document instead", update_spec, doc)
+
+        # Real-time get sees documents that haven't been committed yet
+        for doc in self._get_documents([str(doc['_id'])]):
             updated = self.apply_update(doc, update_spec)
             # A _version_ of 0 will always apply the update
             updated['_version_'] = 0
             self.upsert(updated)
             return updated
 
+    @wrap_exceptions
+    def _get_documents(self, ids):
+        """Iterate over the documents with the given unique keys, including
+        documents that haven't been committed yet.
+
+        Documents are read with Solr's real-time get handler, at most
+        ``chunk_size`` per request. Documents that don't exist are skipped.
+        """
+        ids = list(ids)
+        chunk_size = self.chunk_size if self.chunk_size > 0 else len(ids)
+        for start in range(0, len(ids), max(1, chunk_size)):
+            params = [('id', i) for i in ids[start:start + chunk_size]]
+            params.append(('wt', 'json'))
+            result = decoder.decode(self.solr._send_request(
+                'get', 'get?%s' % safe_urlencode(params, True)))
+            if 'response' in result:
+                for doc in result['response']['docs']:
+                    yield doc
+            elif result.get('doc') is not None:
+                # Response to a request for a single id
+                yield result['doc']
+
     @wrap_exceptions
     def upsert(self, doc):
         """Update or insert a document into Solr
@@ -209,25 +407,82 @@ class DocManager(DocManagerBase):
     def bulk_upsert(self, docs):
         """Update or insert multiple documents into Solr
 
-        docs may be any iterable
+        docs may be any iterable. Documents are cleaned in chunks of
+        ``chunk_size`` by the calling thread and posted in Solr's JSON
+        update format. If ``bulk_senders`` is greater than 1, that many
+        chunks are posted concurrently while the next ones are cleaned, so
+        the documents should have distinct ids, as they do when they come
+        from a collection dump or from consecutive inserts.
         """
-        if self.auto_commit_interval is not None:
-            add_kwargs = {
-                "commit": (self.auto_commit_interval == 0),
-                "commitWithin": str(self.auto_commit_interval)
-            }
-        else:
-            add_kwargs = {"commit": False}
-
         cleaned = (self._clean_doc(d) for d in docs)
-        if self.chunk_size > 0:
-            batch = list(next(cleaned) for i in range(self.chunk_size))
-            while batch:
-                self.solr.add(batch, **add_kwargs)
-                batch = list(next(cleaned)
-                             for i in range(self.chunk_size))
-        else:
-            self.solr.add(cleaned, **add_kwargs)
+
+        def chunks():
+            while True:
+                start = time.time()
+                if self.chunk_size > 0:
+                    chunk = list(itertools.islice(cleaned, self.chunk_size))
+                else:
+                    chunk = list(cleaned)
+                if not chunk:
+                    return
+                BULK_LATENCY.observe(time.time() - start, stage="clean")
+                yield chunk
+
+        if self.bulk_senders <= 1:
+            for chunk in chunks():
+                self._post_documents(chunk)
+            return
+
+        pending = queue.Queue(maxsize=max(1, self.bulk_queue_size))
+        failures = []
+
+        def send():
+            while True:
+                chunk = pending.get()
+                if chunk is None:
+                    return
+                if failures:
+                    # Drain the queue without sending after a failure
+                    continue
+                try:
+                    self._post_documents(chunk)
+                except Exception:
+                    failures.append(sys.exc_info())
+
+        senders = [threading.Thread(target=send)
+                   for i in range(self.bulk_senders)]
+        for thread in senders:
+            thread.daemon = True
+            thread.start()
+        try:
+            for chunk in chunks():
+                if failures:
+                    break
+                pending.put(chunk)
+        finally:
+            for thread in senders:
+                pending.put(None)
+            for thread in senders:
+                thread.join()
+        if failures:
+            reraise(*failures[0])
+
+    def _post_documents(self, docs):
+        """Add a list of cleaned documents to Solr in one JSON update
+        request.
+        """
+        start = time.time()
+        body = json.dumps(docs, default=self.solr._from_python)
+        serialized = time.time()
+        self.solr._send_request(
+            'post', 'update/json?' + self._commit_params(), body=body,
+            headers={'Content-type': 'application/json'})
+        end = time.time()
+        BULK_LATENCY.observe(serialized - start, stage="serialize")
+        BULK_LATENCY.observe(end - serialized, stage="post")
+        logging.debug("Solr DocManager: added %d documents in %.3f seconds "
+                      "(%.3f seconds serializing)", len(docs), end - start,
+                      serialized - start)
 
     @wrap_exceptions
     def remove(self, doc):
@@ -235,8 +490,32 @@ class DocManager(DocManagerBase):
 
         The input is a python dictionary that represents a mongo document.
         """
-        self.solr.delete(id=str(doc["_id"]),
-                         commit=(self.auto_commit_interval == 0))
+        self._delete_ids([str(doc["_id"])])
+
+    @wrap_exceptions
+    def bulk_remove(self, docs):
+        """Remove multiple documents from Solr
+
+        Documents are deleted by id, ``chunk_size`` per request.
+        """
+        ids = (str(doc["_id"]) for doc in docs)
+        while True:
+            if self.chunk_size > 0:
+                chunk = list(itertools.islice(ids, self.chunk_size))
+            else:
+                chunk = list(ids)
+            if not chunk:
+                return
+            self._delete_ids(chunk)
+
+    def _delete_ids(self, ids):
+        """Delete a list of documents by id in one JSON update request,
+        which commits according to ``auto_commit_interval``.
+        """
+        self.solr._send_request(
+            'post', 'update/json?' + self._commit_params(),
+            body=json.dumps({"delete": ids}),
+            headers={'Content-type': 'application/json'})
 
     @wrap_exceptions
     def _remove(self):
@@ -245,18 +524,38 @@ class DocManager(DocManagerBase):
         self.solr.delete(q='*:*', commit=(self.auto_commit_interval == 0))
 
     @wrap_exceptions
-    def _stream_search(self, query):
-        """Helper method for iterating over Solr search results."""
-        for doc in self.solr.search(query, rows=100000000):
-            if self.unique_key != "_id":
-                doc["_id"] = doc.pop(self.unique_key)
-            yield doc
+    def _stream_search(self, query, fields=None):
+        """Helper method for iterating over Solr search results.
+
+        Results are fetched lazily, ``search_page_size`` at a time, with a
+        cursor sorted on the unique key. If ``fields`` is given, only those
+        fields are fetched.
+        """
+        params = {'q': query,
+                  'sort': '%s asc' % self.unique_key,
+                  'rows': self.search_page_size,
+                  'cursorMark': '*'}
+        if fields is not None:
+            params['fl'] = ','.join(fields)
+        while True:
+            result = decoder.decode(self.solr._select(dict(params)))
+            for doc in result['response']['docs']:
+                if self.unique_key != "_id":
+                    doc["_id"] = doc.pop(self.unique_key)
+                yield doc
+            # The cursor mark stays the same once all results were read
+            next_mark = result.get('nextCursorMark')
+            if next_mark is None or next_mark == params['cursorMark']:
+                return
+            params['cursorMark'] = next_mark
 
     @wrap_exceptions
     def search(self, start_ts, end_ts):
         """Called to query Solr for documents in a time range."""
         query = '_ts: [%s TO %s]' % (start_ts, end_ts)
-        return self._stream_search(query)
+        # Rollbacks only need the id and metadata
+        return self._stream_search(
+            query, fields=[self.unique_key, 'ns', '_ts'])
 
     @wrap_exceptions
     def _search(self, query):
@@ -276,7 +575,8 @@ class DocManager(DocManagerBase):
         """
         #search everything, sort by descending timestamp, return 1 row
         try:
-            result = self.solr.search('*:*', sort='_ts desc', rows=1)
+            result = self.solr.search('*:*', sort='_ts desc', rows=1,
+                                      fl='%s,ns,_ts' % self.unique_key)
         except ValueError:
             return None
 
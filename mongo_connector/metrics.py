@@ -0,0 +1,362 @@
+# Copyright 2013-2014 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics describing the progress of mongo-connector.
+
+Metrics are kept in a Registry and can be served over HTTP in the
+Prometheus text format by start_http_server.
+"""
+
+import bisect
+import logging
+import math
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Upper bounds in seconds of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+def format_value(value):
+    """Format a sample value for the Prometheus text format."""
+    if value == float("inf"):
+        return "+Inf"
+    elif value == float("-inf"):
+        return "-Inf"
+    elif math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    """Format a list of (name, value) label pairs for the Prometheus text
+    format.
+    """
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace(
+            "\n", "\\n").replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return "{%s}" % ",".join(pairs)
+
+
+class Metric(object):
+    """Base class for metrics, which hold a value for each combination of
+    label values.
+
+    Instead of being updated, the value for a combination of label values
+    may be computed by a function each time the metric is collected. See
+    ``set_function``.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._functions = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Metric %s takes labels %r, got %r"
+                             % (self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function, **labels):
+        """Compute the value for some label values by calling ``function``
+        each time this metric is collected. The function may return None if
+        there is no value to report.
+        """
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def remove(self, **labels):
+        """Forget the value for some label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+            self._functions.pop(key, None)
+
+    def get(self, **labels):
+        """Return the current value for some label values, or None."""
+        key = self._key(labels)
+        with self._lock:
+            function = self._functions.get(key)
+            if function is None:
+                return self._values.get(key)
+        return function()
+
+    def samples(self):
+        """Return a list of (suffix, labels, value) samples of this metric.
+        """
+        with self._lock:
+            values = list(self._values.items())
+            functions = list(self._functions.items())
+        samples = []
+        for key, value in values:
+            samples.extend(self._samples(key, value))
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                logging.exception("Could not collect metric %s", self.name)
+                continue
+            if value is not None:
+                samples.extend(self._samples(key, value))
+        return samples
+
+    def _samples(self, key, value):
+        return [("", list(zip(self.labelnames, key)), value)]
+
+    def exposition(self):
+        """Return this metric in the Prometheus text format."""
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.metric_type)]
+        for suffix, labels, value in sorted(self.samples()):
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        format_labels(labels),
+                                        format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount`` to the value for some label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that may go up and down."""
+
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        """Set the value for some label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """Add ``amount`` to the value for some label values."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """Counts of observed values, by the buckets they fall into."""
+
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        buckets = sorted(buckets)
+        if buckets[-1] != float("inf"):
+            buckets.append(float("inf"))
+        self.buckets = tuple(buckets)
+
+    def set_function(self, function, **labels):
+        raise NotImplementedError("Histograms cannot be computed by a "
+                                  "function")
+
+    def observe(self, value, **labels):
+        """Record a value for some label values."""
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {
+                    "buckets": [0] * len(self.buckets), "sum": 0.0}
+            state["buckets"][index] += 1
+            state["sum"] += value
+
+    def time(self, **labels):
+        """Return a context manager that observes the number of seconds
+        spent inside it.
+        """
+        return _Timer(self, labels)
+
+    def get(self, **labels):
+        """Return the number of values recorded for some label values."""
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            return sum(state["buckets"]) if state else 0
+
+    def _samples(self, key, value):
+        labels = list(zip(self.labelnames, key))
+        samples = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets, value["buckets"]):
+            count += bucket_count
+            samples.append(("_bucket", labels + [("le", format_value(bound))],
+                            count))
+        samples.append(("_count", labels, count))
+        samples.append(("_sum", labels, value["sum"]))
+        return samples
+
+    def samples(self):
+        with self._lock:
+            # Copy the bucket counts, which observe() updates in place
+            values = [(key, {"buckets": list(state["buckets"]),
+                             "sum": state["sum"]})
+                      for key, state in self._values.items()]
+        samples = []
+        for key, value in values:
+            samples.extend(self._samples(key, value))
+        return samples
+
+
+class _Timer(object):
+    """Context manager returned by Histogram.time."""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Registry(object):
+    """A collection of metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add a metric to this registry and return it.
+
+        If an identical metric is already registered, for example because
+        the module defining it was loaded again, that metric is returned
+        instead.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if (type(existing) is type(metric) and
+                        existing.labelnames == metric.labelnames):
+                    return existing
+                raise ValueError("Metric %s is already registered"
+                                 % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        """Return the metric with the given name, or None."""
+        with self._lock:
+            return self._metrics.get(name)
+
+    def exposition(self):
+        """Return all metrics in the Prometheus text format."""
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return "".join(metric.exposition() for _, metric in metrics)
+
+
+REGISTRY = Registry()
+
+OPLOG_ENTRIES_READ = REGISTRY.register(Counter(
+    "mongo_connector_oplog_entries_read_total",
+    "Number of oplog entries read.", ["shard"]))
+OPERATIONS_READ = REGISTRY.register(Counter(
+    "mongo_connector_operations_read_total",
+    "Number of operations read from the oplog.", ["shard", "op"]))
+OPERATIONS_APPLIED = REGISTRY.register(Counter(
+    "mongo_connector_operations_applied_total",
+    "Number of operations applied to a target system.",
+    ["shard", "target", "op"]))
+OPLOG_LAG = REGISTRY.register(Gauge(
+    "mongo_connector_oplog_lag_seconds",
+    "Seconds between the checkpoint and the newest oplog entry.",
+    ["shard"]))
+CURSOR_POSITIONING = REGISTRY.register(Gauge(
+    "mongo_connector_cursor_positioning_seconds",
+    "Seconds taken to position the oplog cursor the last time.",
+    ["shard"]))
+TARGET_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "mongo_connector_target_queue_batches",
+    "Number of batches of operations waiting to be applied to a target "
+    "system.", ["shard", "target"]))
+DOC_MANAGER_LATENCY = REGISTRY.register(Histogram(
+    "mongo_connector_doc_manager_call_seconds",
+    "Seconds taken by calls to DocManager methods.", ["target", "method"]))
+DUMP_DOCUMENTS = REGISTRY.register(Counter(
+    "mongo_connector_dump_documents_total",
+    "Number of documents upserted by collection dumps.", ["shard", "ns"]))
+DUMP_RANGES_REMAINING = REGISTRY.register(Gauge(
+    "mongo_connector_dump_ranges_remaining",
+    "Number of ranges of collections left to dump.", ["shard"]))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics of a registry."""
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics: " + format, *args)
+
+
+def start_http_server(port, address="localhost", registry=REGISTRY):
+    """Serve the metrics of a registry on /metrics from a daemon thread.
+
+    Returns the HTTPServer, which may be stopped with ``shutdown()``.
+    """
+    handler = type("MetricsHandler", (MetricsHandler,),
+                   {"registry": registry})
+    server = HTTPServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Metrics: serving metrics on http://%s:%d/metrics",
+                 address, server.server_port)
+    return server
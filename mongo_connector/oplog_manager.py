@@ -16,6 +16,8 @@
 """
 
 import bson
+import copy
+import itertools
 import logging
 try:
     import Queue as queue
@@ -26,13 +28,90 @@ import sys
 import time
 import threading
 import traceback
-from mongo_connector import errors, util
-from mongo_connector.constants import DEFAULT_BATCH_SIZE
+from mongo_connector import errors, metrics, util
+from mongo_connector.constants import (DEFAULT_BATCH_SIZE,
+                                       DEFAULT_BUFFER_SIZE,
+                                       DEFAULT_BUFFER_TIMEOUT,
+                                       DEFAULT_DUMP_CHUNK_SIZE,
+                                       DEFAULT_DUMP_WORKERS,
+                                       DEFAULT_MAX_BACKOFF,
+                                       DEFAULT_MIN_BACKOFF,
+                                       DEFAULT_SUMMARY_INTERVAL,
+                                       DEFAULT_WORKER_QUEUE_SIZE)
 from mongo_connector.util import retry_until_ok
 
 from pymongo import MongoClient
 
 
+# Names of the operation types in metrics
+OPERATION_NAMES = {'d': 'remove', 'i': 'upsert', 'u': 'update'}
+
+
+class DocManagerWorker(threading.Thread):
+    """DocManagerWorker applies batches of oplog operations to a single
+    DocManager.
+
+    Each DocManager has its own worker and checkpoint, so that a slow target
+    system doesn't hold back the others until its queue fills up.
+    """
+    def __init__(self, oplog_thread, index, doc_manager, queue_size):
+        super(DocManagerWorker, self).__init__()
+        self.daemon = True
+
+        #The OplogThread feeding this worker
+        self.oplog_thread = oplog_thread
+
+        #Position of the DocManager in the OplogThread's list of DocManagers
+        self.index = index
+
+        self.doc_manager = doc_manager
+
+        #Batches of (timestamp, operations) waiting to be applied
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        #Timestamp of the last oplog entry applied to the DocManager
+        self.checkpoint = None
+
+        #Set when an unexpected error prevents applying further batches
+        self.failed = False
+
+        #Number of operations of each type applied to the DocManager
+        self.counts = {'d': 0, 'i': 0, 'u': 0}
+
+        #Identifies the DocManager in metrics
+        self.target = oplog_thread.target_label(doc_manager)
+
+    def run(self):
+        """Apply batches until a None batch is received.
+        """
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.failed:
+                    continue
+                timestamp, operations = batch
+                if self.checkpoint is not None:
+                    # Skip operations this DocManager has already applied
+                    applied = util.bson_ts_to_long(self.checkpoint)
+                    operations = [o for o in operations
+                                  if o[1]['_ts'] > applied]
+                self.oplog_thread.apply_operations(
+                    self.doc_manager, operations)
+                for op, _, _ in operations:
+                    self.counts[op] += 1
+                self.checkpoint = timestamp
+                self.oplog_thread.update_target_checkpoint(self)
+            except Exception:
+                logging.exception("DocManagerWorker: unable to apply "
+                                  "operations to %r", self.doc_manager)
+                self.failed = True
+                self.oplog_thread.running = False
+            finally:
+                self.queue.task_done()
+
+
 class OplogThread(threading.Thread):
     """OplogThread gathers the updates for a single oplog.
     """
@@ -40,13 +119,30 @@ class OplogThread(threading.Thread):
                  doc_manager, oplog_progress_dict, namespace_set, auth_key,
                  auth_username, repl_set=None, collection_dump=True,
                  batch_size=DEFAULT_BATCH_SIZE, fields=None,
-                 dest_mapping={}, continue_on_error=False):
+                 dest_mapping={}, continue_on_error=False,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 buffer_timeout=DEFAULT_BUFFER_TIMEOUT,
+                 worker_queue_size=DEFAULT_WORKER_QUEUE_SIZE,
+                 dump_workers=DEFAULT_DUMP_WORKERS,
+                 dump_chunk_size=DEFAULT_DUMP_CHUNK_SIZE,
+                 trace_sample=0,
+                 summary_interval=DEFAULT_SUMMARY_INTERVAL):
         """Initialize the oplog thread.
         """
         super(OplogThread, self).__init__()
 
         self.batch_size = batch_size
 
+        #Maximum number of oplog entries to apply to the DocManagers at once
+        self.buffer_size = buffer_size
+
+        #Maximum number of seconds an entry may wait before being applied
+        self.buffer_timeout = buffer_timeout
+
+        #Bounds on the number of seconds to wait before re-opening the cursor
+        self.min_backoff = DEFAULT_MIN_BACKOFF
+        self.max_backoff = DEFAULT_MAX_BACKOFF
+
         #The connection to the primary for this replicaSet.
         self.primary_connection = primary_conn
 
@@ -65,6 +161,9 @@ class OplogThread(threading.Thread):
         #Boolean describing whether the cluster is sharded or not
         self.is_sharded = is_sharded
 
+        #The name of the replica set, which identifies this thread in metrics
+        self.repl_set = repl_set
+
         #A document manager for each target system.
         #These are the same for all threads.
         if type(doc_manager) == list:
@@ -75,9 +174,38 @@ class OplogThread(threading.Thread):
         #Boolean describing whether or not the thread is running.
         self.running = True
 
+        #A DocManagerWorker for each DocManager, created when the thread runs.
+        self.workers = []
+
+        #Maximum number of batches waiting to be applied to each DocManager
+        self.worker_queue_size = worker_queue_size
+
         #Stores the timestamp of the last oplog entry read.
         self.checkpoint = None
 
+        #Timestamp of the last oplog entry skipped while no operations were
+        #buffered. Everything before it has been handed to the DocManagers.
+        self.skipped_ts = None
+
+        #Number of oplog entries read, and number of operations of each type
+        #handed to the DocManagers.
+        self.entries_read = 0
+        self.counts = {'d': 0, 'i': 0, 'u': 0}
+
+        #Log one in every trace_sample oplog entries read at DEBUG level, or
+        #none if trace_sample is 0.
+        self.trace_sample = trace_sample
+
+        #Number of seconds between summaries of the operations read, or 0 to
+        #disable the summaries.
+        self.summary_interval = summary_interval
+        self.last_summary_time = time.time()
+        self.last_summary_counts = dict(self.counts)
+        self.last_summary_entries = 0
+
+        #Seconds taken by init_cursor to position the cursor the last time.
+        self.positioning_time = None
+
         #A dictionary that stores OplogThread/timestamp pairs.
         #Represents the last checkpoint for a OplogThread.
         self.oplog_progress = oplog_progress_dict
@@ -91,6 +219,12 @@ class OplogThread(threading.Thread):
         #Whether the collection dump gracefully handles exceptions
         self.continue_on_error = continue_on_error
 
+        #Number of threads reading ranges of collections during a dump
+        self.dump_workers = dump_workers
+
+        #Number of documents upserted between updates of the dump progress
+        self.dump_chunk_size = dump_chunk_size
+
         #If authentication is used, this is an admin password.
         self.auth_key = auth_key
 
@@ -136,9 +270,19 @@ class OplogThread(threading.Thread):
         """Start the oplog worker.
         """
         logging.debug("OplogThread: Run thread started")
+        self.start_workers()
+        self.register_metrics()
+        # Seconds to wait before re-opening the cursor after it dies or an
+        # error occurs. This doubles after each attempt that doesn't return
+        # any oplog entries.
+        backoff = self.min_backoff
         while self.running is True:
+            # Workers must be idle before the cursor is repositioned, since
+            # repositioning may roll back the target systems.
+            self.wait_for_workers()
             logging.debug("OplogThread: Getting cursor")
-            cursor, cursor_len = self.init_cursor()
+            self.skipped_ts = None
+            cursor, cursor_empty = self.init_cursor()
 
             # we've fallen too far behind
             if cursor is None and self.checkpoint is not None:
@@ -148,123 +292,77 @@ class OplogThread(threading.Thread):
                 self.running = False
                 continue
 
-            if cursor_len == 0:
-                logging.debug("OplogThread: Last entry is the one we "
-                              "already processed.  Up to date.  Sleeping.")
-                time.sleep(1)
+            if cursor is None:
+                logging.debug("OplogThread: Nothing in the oplog yet. "
+                              "Retrying in %.1f seconds.", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
                 continue
 
-            logging.debug("OplogThread: Got the cursor, count is %d"
-                          % cursor_len)
+            if cursor_empty:
+                logging.debug("OplogThread: Last entry is the one we "
+                              "already processed.  Up to date.  Tailing.")
+            else:
+                logging.debug("OplogThread: Got the cursor, go go go!")
 
-            last_ts = None
             err = False
-            remove_inc = 0
-            upsert_inc = 0
-            update_inc = 0
+            # Operations waiting to be applied to the DocManagers, the
+            # timestamp of the last oplog entry buffered, and the time at
+            # which the oldest buffered operation was read.
+            buffered = []
+            buffered_ts = None
+            buffered_since = None
             try:
                 logging.debug("OplogThread: about to process new oplog "
                               "entries")
                 while cursor.alive and self.running:
-                    logging.debug("OplogThread: Cursor is still"
-                                  " alive and thread is still running.")
-                    for n, entry in enumerate(cursor):
-
-                        logging.debug("OplogThread: Iterating through cursor,"
-                                      " document number in this cursor is %d"
-                                      % n)
+                    for entry in cursor:
                         # Break out if this thread should stop
                         if not self.running:
                             break
 
-                        # Don't replicate entries resulting from chunk moves
-                        if entry.get("fromMigrate"):
-                            continue
-
-                        # Take fields out of the oplog entry that
-                        # shouldn't be replicated. This may nullify
-                        # the document if there's nothing to do.
-                        if not self.filter_oplog_entry(entry):
+                        # The cursor is working again
+                        backoff = self.min_backoff
+
+                        operation = self.get_operation(entry)
+                        self.entries_read += 1
+                        if (self.trace_sample and
+                                self.entries_read % self.trace_sample == 0):
+                            logging.debug("OplogThread: trace: read entry %r "
+                                          "as operation %r", entry, operation)
+                        self.log_summary()
+                        if operation is not None:
+                            buffered.append(operation)
+                            buffered_ts = entry['ts']
+                            if buffered_since is None:
+                                buffered_since = time.time()
+                        if not buffered:
+                            self.skipped_ts = entry['ts']
                             continue
 
-                        #sync the current oplog operation
-                        operation = entry['op']
-                        ns = entry['ns']
-
-                        if '.' not in ns:
-                            continue
-
-                        coll = ns.split('.', 1)[1]
-                        if coll.startswith("system."):
-                            continue
-
-                        # use namespace mapping if one exists
-                        ns = self.dest_mapping.get(entry['ns'], ns)
-
-                        for docman in self.doc_managers:
-                            try:
-                                logging.debug("OplogThread: Operation for this "
-                                              "entry is %s" % str(operation))
-
-                                # Remove
-                                if operation == 'd':
-                                    entry['_id'] = entry['o']['_id']
-                                    entry['ns'] = ns
-                                    entry['_ts'] = util.bson_ts_to_long(
-                                        entry['ts'])
-                                    docman.remove(entry)
-                                    remove_inc += 1
-                                # Insert
-                                elif operation == 'i':  # Insert
-                                    # Retrieve inserted document from
-                                    # 'o' field in oplog record
-                                    doc = entry.get('o')
-                                    # Extract timestamp and namespace
-                                    doc['_ts'] = util.bson_ts_to_long(
-                                        entry['ts'])
-                                    doc['ns'] = ns
-                                    docman.upsert(doc)
-                                    upsert_inc += 1
-                                # Update
-                                elif operation == 'u':
-                                    doc = {"_id": entry['o2']['_id'],
-                                           "_ts": util.bson_ts_to_long(
-                                               entry['ts']),
-                                           "ns": ns}
-                                    # 'o' field contains the update spec
-                                    docman.update(doc, entry.get('o', {}))
-                                    update_inc += 1
-                            except errors.OperationFailed:
-                                logging.exception(
-                                    "Unable to process oplog document %r"
-                                    % entry)
-                            except errors.ConnectionFailed:
-                                logging.exception(
-                                    "Connection failed while processing oplog "
-                                    "document %r" % entry)
-
-                        if (remove_inc + upsert_inc + update_inc) % 1000 == 0:
-                            logging.debug(
-                                "OplogThread: Documents removed: %d, "
-                                "inserted: %d, updated: %d so far" % (
-                                    remove_inc, upsert_inc, update_inc))
-
-                        logging.debug("OplogThread: Doc is processed.")
-
-                        last_ts = entry['ts']
-
-                        # update timestamp per batch size
-                        # n % -1 (default for self.batch_size) == 0 for all n
-                        if n % self.batch_size == 1 and last_ts is not None:
-                            self.checkpoint = last_ts
-                            self.update_checkpoint()
-
-                    # update timestamp after running through oplog
-                    if last_ts is not None:
+                        # Flush the buffer once it is full or too old, or
+                        # before waiting on the server for more entries. The
+                        # checkpoint only advances after a flush, so
+                        # self.batch_size also bounds the buffer.
+                        if (len(buffered) >= self.buffer_size
+                                or len(buffered) == self.batch_size
+                                or time.time() - buffered_since >=
+                                self.buffer_timeout
+                                or util.cursor_batch_exhausted(cursor)):
+                            self.flush_operations(buffered, buffered_ts)
+                            buffered = []
+                            buffered_since = None
+
+                    # flush and update timestamp after running through oplog
+                    if buffered:
                         logging.debug("OplogThread: updating checkpoint after"
                                       "processing new oplog entries")
-                        self.checkpoint = last_ts
-                        self.update_checkpoint()
+                        self.flush_operations(buffered, buffered_ts)
+                        buffered = []
+                        buffered_since = None
+
+                    # Log the summary while the oplog is idle, too
+                    self.log_summary()
 
             except (pymongo.errors.AutoReconnect,
                     pymongo.errors.OperationFailure,
@@ -281,19 +379,275 @@ class OplogThread(threading.Thread):
                     self.auth_username, self.auth_key)
                 err = False
 
-            # update timestamp before attempting to reconnect to MongoDB,
-            # after being join()'ed, or if the cursor closes
-            if last_ts is not None:
+            # apply buffered operations and update timestamp before
+            # attempting to reconnect to MongoDB, after being join()'ed, or
+            # if the cursor closes
+            if buffered:
                 logging.debug("OplogThread: updating checkpoint after an "
                               "Exception, cursor closing, or join() on this"
                               "thread.")
-                self.checkpoint = last_ts
-                self.update_checkpoint()
+                self.flush_operations(buffered, buffered_ts)
+
+            if self.running:
+                logging.debug("OplogThread: Cursor closed. Reconnecting in "
+                              "%.1f seconds.", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+        self.stop_workers()
+        self.log_summary(force=True)
+        self.unregister_metrics()
+
+    def register_metrics(self):
+        """Report the progress of this thread and its workers through the
+        metrics module.
+        """
+        shard = self.repl_set
+        metrics.OPLOG_ENTRIES_READ.set_function(
+            lambda: self.entries_read, shard=shard)
+        metrics.OPLOG_LAG.set_function(self.get_lag, shard=shard)
+        metrics.CURSOR_POSITIONING.set_function(
+            lambda: self.positioning_time, shard=shard)
+        for op, name in OPERATION_NAMES.items():
+            metrics.OPERATIONS_READ.set_function(
+                lambda op=op: self.counts[op], shard=shard, op=name)
+        for worker in self.workers:
+            metrics.TARGET_QUEUE_DEPTH.set_function(
+                worker.queue.qsize, shard=shard, target=worker.target)
+            for op, name in OPERATION_NAMES.items():
+                metrics.OPERATIONS_APPLIED.set_function(
+                    lambda worker=worker, op=op: worker.counts[op],
+                    shard=shard, target=worker.target, op=name)
+
+    def unregister_metrics(self):
+        """Stop reporting the progress of this thread through the metrics
+        module.
+        """
+        shard = self.repl_set
+        metrics.OPLOG_ENTRIES_READ.remove(shard=shard)
+        metrics.OPLOG_LAG.remove(shard=shard)
+        metrics.CURSOR_POSITIONING.remove(shard=shard)
+        for name in OPERATION_NAMES.values():
+            metrics.OPERATIONS_READ.remove(shard=shard, op=name)
+        for worker in self.workers:
+            metrics.TARGET_QUEUE_DEPTH.remove(shard=shard,
+                                              target=worker.target)
+            for name in OPERATION_NAMES.values():
+                metrics.OPERATIONS_APPLIED.remove(
+                    shard=shard, target=worker.target, op=name)
+
+    def get_lag(self):
+        """Return the number of seconds between the checkpoint and the newest
+        entry in the oplog, or None if there is no checkpoint yet.
+
+        Only entries in the namespace set are considered, and entries
+        skipped after every flushed batch has been applied count as
+        replicated, so that entries which are never replicated don't make an
+        idle target fall behind.
+        """
+        skipped_ts = self.skipped_ts
+        flushed_ts = self.checkpoint
+        checkpoint = self.read_last_checkpoint()
+        if checkpoint is None:
+            return None
+        if (skipped_ts is not None and checkpoint == flushed_ts and
+                skipped_ts > checkpoint):
+            checkpoint = skipped_ts
+        newest = self.get_last_oplog_timestamp()
+        if newest is None:
+            return None
+        return max(newest.time - checkpoint.time, 0)
+
+    def target_label(self, docman):
+        """Return the label identifying a DocManager in metrics."""
+        try:
+            index = self.doc_managers.index(docman)
+        except ValueError:
+            index = -1
+        return "%d:%s" % (index, type(docman).__module__.rsplit(".", 1)[-1])
+
+    def get_operation(self, entry):
+        """Translate an oplog entry into an operation for the DocManagers.
+
+        Returns a tuple ``(op, doc, update_spec)``, where ``op`` is one of
+        'd', 'i' or 'u', or None if the entry should not be replicated.
+        """
+        # Don't replicate entries resulting from chunk moves
+        if entry.get("fromMigrate"):
+            return None
+
+        # Take fields out of the oplog entry that
+        # shouldn't be replicated. This may nullify
+        # the document if there's nothing to do.
+        if not self.filter_oplog_entry(entry):
+            return None
+
+        ns = entry['ns']
+        if '.' not in ns:
+            return None
+
+        coll = ns.split('.', 1)[1]
+        if coll.startswith("system."):
+            return None
+
+        # use namespace mapping if one exists
+        ns = self.dest_mapping.get(entry['ns'], ns)
+
+        operation = entry['op']
+        timestamp = util.bson_ts_to_long(entry['ts'])
+        # Remove
+        if operation == 'd':
+            doc = {'_id': entry['o']['_id'], 'ns': ns, '_ts': timestamp}
+            return 'd', doc, None
+        # Insert
+        elif operation == 'i':
+            # Retrieve inserted document from 'o' field in oplog record
+            doc = entry.get('o')
+            # Extract timestamp and namespace
+            doc['_ts'] = timestamp
+            doc['ns'] = ns
+            return 'i', doc, None
+        # Update
+        elif operation == 'u':
+            doc = {"_id": entry['o2']['_id'], "_ts": timestamp, "ns": ns}
+            # 'o' field contains the update spec
+            return 'u', doc, entry.get('o', {})
+        return None
+
+    def flush_operations(self, operations, timestamp):
+        """Hand a batch of buffered operations to every DocManager's worker.
+
+        ``timestamp`` is the timestamp of the last oplog entry in the batch.
+        Each worker advances its own checkpoint to it once the batch has been
+        applied.
+        """
+        for worker in self.workers:
+            if len(self.workers) > 1:
+                # DocManagers may modify the documents they are given
+                ops = [(op, dict(doc), spec and dict(spec))
+                       for op, doc, spec in operations]
+            else:
+                ops = operations
+            # Block while the worker's queue is full. Batches flushed while
+            # this thread is stopping are still applied by stop_workers.
+            worker.queue.put((timestamp, ops))
+        self.checkpoint = timestamp
+
+        for op, _, _ in operations:
+            self.counts[op] += 1
+
+    def log_summary(self, force=False):
+        """Log the number of operations read since the last summary, at most
+        once every ``self.summary_interval`` seconds unless ``force`` is True.
+        """
+        now = time.time()
+        elapsed = now - self.last_summary_time
+        if not self.summary_interval or (
+                elapsed < self.summary_interval and not force):
+            return
+        last = self.last_summary_counts
+        removed = self.counts['d'] - last['d']
+        upserted = self.counts['i'] - last['i']
+        updated = self.counts['u'] - last['u']
+        try:
+            lag = self.get_lag()
+        except pymongo.errors.PyMongoError:
+            lag = None
+        logging.info("OplogThread: %d entries read, %d documents removed, "
+                     "%d upserted, %d updated in the last %.1f seconds "
+                     "(%.1f operations/sec). Checkpoint is %s, %s seconds "
+                     "behind the oplog.",
+                     self.entries_read - self.last_summary_entries,
+                     removed, upserted, updated, elapsed,
+                     (removed + upserted + updated) / max(elapsed, 1e-6),
+                     self.checkpoint, lag)
+        self.last_summary_time = now
+        self.last_summary_counts = dict(self.counts)
+        self.last_summary_entries = self.entries_read
+
+    def start_workers(self):
+        """Start a DocManagerWorker for each DocManager."""
+        self.workers = []
+        with self.oplog_progress as oplog_prog:
+            oplog_dict = oplog_prog.get_dict()
+            for index, docman in enumerate(self.doc_managers):
+                worker = DocManagerWorker(self, index, docman,
+                                          self.worker_queue_size)
+                if len(self.doc_managers) > 1:
+                    worker.checkpoint = oplog_dict.get(self.target_key(index))
+                self.workers.append(worker)
+        for worker in self.workers:
+            worker.start()
+
+    def wait_for_workers(self):
+        """Block until every worker has applied all of its queued batches."""
+        for worker in self.workers:
+            worker.queue.join()
+
+    def stop_workers(self):
+        """Apply any queued batches and stop all workers."""
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def apply_operations(self, docman, operations):
+        """Apply a sequence of operations to a DocManager, in order.
+
+        Runs of consecutive inserts are sent through ``bulk_upsert``, and
+        runs of consecutive removes through ``bulk_remove``. If a bulk call
+        fails, the operations in that run are retried one by one, so that a
+        single bad document doesn't prevent the others from being applied.
+        """
+        target = self.target_label(docman)
+        bulk_methods = {'i': 'bulk_upsert', 'd': 'bulk_remove'}
+        for op, run in itertools.groupby(operations, key=lambda o: o[0]):
+            run = list(run)
+            method = bulk_methods.get(op)
+            bulk = method and getattr(docman, method, None)
+            if bulk is not None and len(run) > 1:
+                try:
+                    # DocManagers may modify the documents they are given,
+                    # which are needed again if the bulk call fails
+                    with metrics.DOC_MANAGER_LATENCY.time(target=target,
+                                                          method=method):
+                        bulk([dict(doc) for _, doc, _ in run])
+                    continue
+                except (errors.OperationFailed, errors.ConnectionFailed):
+                    logging.exception(
+                        "OplogThread: bulk operation failed, applying %d "
+                        "operations one at a time", len(run))
+            for operation in run:
+                self.apply_operation(docman, operation, target)
+
+    def apply_operation(self, docman, operation, target=None):
+        """Apply a single operation to a DocManager.
 
-            logging.debug("OplogThread: Sleeping. Documents removed: %d, "
-                          "upserted: %d, updated: %d"
-                          % (remove_inc, upsert_inc, update_inc))
-            time.sleep(2)
+        ``target`` is the label identifying the DocManager in metrics.
+        """
+        op, doc, spec = operation
+        if target is None:
+            target = self.target_label(docman)
+        try:
+            if op == 'd':
+                with metrics.DOC_MANAGER_LATENCY.time(target=target,
+                                                      method='remove'):
+                    docman.remove(doc)
+            elif op == 'i':
+                with metrics.DOC_MANAGER_LATENCY.time(target=target,
+                                                      method='upsert'):
+                    docman.upsert(doc)
+            elif op == 'u':
+                with metrics.DOC_MANAGER_LATENCY.time(target=target,
+                                                      method='update'):
+                    docman.update(doc, spec)
+        except errors.OperationFailed:
+            logging.exception(
+                "Unable to process oplog document %r", doc)
+        except errors.ConnectionFailed:
+            logging.exception(
+                "Connection failed while processing oplog "
+                "document %r", doc)
 
     def join(self):
         """Stop this thread from managing the oplog.
@@ -343,6 +697,10 @@ class OplogThread(threading.Thread):
                 tailable=True, await_data=True)
         else:
             query['ts'] = {'$gte': timestamp}
+            if self.namespace_set:
+                # Always return the entry at the timestamp itself, since
+                # init_cursor positions the cursor by finding it
+                query['$or'] = [{'ns': query.pop('ns')}, {'ts': timestamp}]
             cursor = self.oplog.find(
                 query, tailable=True, await_data=True)
             # Applying 8 as the mask to the cursor enables OplogReplay
@@ -354,6 +712,15 @@ class OplogThread(threading.Thread):
 
         This method is called when we're initializing the cursor and have no
         configs i.e. when we're starting for the first time.
+
+        If ``self.dump_workers`` is greater than 1, each collection is split
+        into ranges of ``_id`` that are read and upserted concurrently by a
+        pool of that many threads. Each chunk of documents read is upserted
+        into the target systems concurrently.
+
+        The progress of the dump is kept in the oplog progress dictionary, so
+        that a dump that was interrupted resumes where it left off instead of
+        starting over.
         """
 
         dump_set = self.namespace_set or []
@@ -373,121 +740,217 @@ class OplogThread(threading.Thread):
                     namespace = "%s.%s" % (database, coll)
                     dump_set.append(namespace)
 
-        timestamp = util.retry_until_ok(self.get_last_oplog_timestamp)
-        if timestamp is None:
-            return None
+        progress = self.read_dump_progress()
+        if progress is None:
+            timestamp = util.retry_until_ok(self.get_last_oplog_timestamp)
+            if timestamp is None:
+                return None
+            progress = {"ts": timestamp, "completed": [], "ranges": {}}
+        else:
+            timestamp = progress["ts"]
+            logging.info("OplogThread: resuming collection dump started at "
+                         "oplog timestamp %s, %d namespaces already dumped"
+                         % (timestamp, len(progress["completed"])))
         long_ts = util.bson_ts_to_long(timestamp)
 
-        def docs_to_dump():
-            for namespace in dump_set:
-                logging.info("OplogThread: dumping collection %s"
-                             % namespace)
-                database, coll = namespace.split('.', 1)
-                last_id = None
-                attempts = 0
-
-                # Loop to handle possible AutoReconnect
-                while attempts < 60:
-                    target_coll = self.main_connection[database][coll]
-                    if not last_id:
-                        cursor = util.retry_until_ok(
-                            target_coll.find,
-                            fields=self._fields,
-                            sort=[("_id", pymongo.ASCENDING)]
-                        )
-                    else:
-                        cursor = util.retry_until_ok(
-                            target_coll.find,
-                            {"_id": {"$gt": last_id}},
-                            fields=self._fields,
-                            sort=[("_id", pymongo.ASCENDING)]
-                        )
-                    try:
-                        for doc in cursor:
-                            if not self.running:
-                                raise StopIteration
-                            doc["ns"] = self.dest_mapping.get(
-                                namespace, namespace)
-                            doc["_ts"] = long_ts
-                            last_id = doc["_id"]
-                            yield doc
-                        break
-                    except pymongo.errors.AutoReconnect:
-                        attempts += 1
-                        time.sleep(1)
-
-        def upsert_each(dm):
-            num_inserted = 0
+        # Each range is a list [lower, upper, last_id], where last_id is the
+        # _id of the last document upserted from that range. Completed
+        # ranges are replaced by None.
+        for namespace in dump_set:
+            if (namespace in progress["completed"]
+                    or namespace in progress["ranges"]):
+                continue
+            split_points = self.get_split_points(namespace,
+                                                 self.dump_workers)
+            bounds = [None] + split_points + [None]
+            progress["ranges"][namespace] = [
+                [lower, upper, None]
+                for lower, upper in zip(bounds[:-1], bounds[1:])]
+        self.update_dump_progress(progress)
+        progress_lock = threading.Lock()
+
+        def docs_to_dump(namespace, lower, upper, last_id):
+            logging.info("OplogThread: dumping collection %s" % namespace)
+            database, coll = namespace.split('.', 1)
+            range_query = self.get_range_query(lower, upper)
+            attempts = 0
+
+            # Loop to handle possible AutoReconnect
+            while attempts < 60:
+                target_coll = self.main_connection[database][coll]
+                if last_id is None:
+                    query = range_query
+                else:
+                    query = {"$and": [range_query,
+                                      self.get_resume_query(last_id)]}
+                cursor = util.retry_until_ok(
+                    target_coll.find,
+                    query,
+                    fields=self._fields,
+                    sort=[("_id", pymongo.ASCENDING)]
+                )
+                try:
+                    for doc in cursor:
+                        if not self.running:
+                            return
+                        doc["ns"] = self.dest_mapping.get(
+                            namespace, namespace)
+                        doc["_ts"] = long_ts
+                        last_id = doc["_id"]
+                        yield doc
+                    break
+                except pymongo.errors.AutoReconnect:
+                    attempts += 1
+                    time.sleep(1)
+
+        def upsert_each(dm, docs):
             num_failed = 0
-            for num, doc in enumerate(docs_to_dump()):
-                if num % 10000 == 0:
-                    logging.debug("Upserted %d docs." % num)
+            for doc in docs:
                 try:
                     dm.upsert(doc)
-                    num_inserted += 1
                 except Exception:
                     if self.continue_on_error:
                         logging.exception(
-                            "Could not upsert document: %r" % doc)
+                            "Could not upsert document: %r", doc)
                         num_failed += 1
                     else:
                         raise
-            logging.debug("Upserted %d docs" % num_inserted)
             if num_failed > 0:
-                logging.error("Failed to upsert %d docs" % num_failed)
+                logging.error("Failed to upsert %d docs", num_failed)
 
-        def upsert_all(dm):
+        def upsert_all(dm, docs):
+            # Bulk upsert if possible
+            if not hasattr(dm, "bulk_upsert"):
+                upsert_each(dm, docs)
+                return
             try:
-                dm.bulk_upsert(docs_to_dump())
+                if self.continue_on_error:
+                    # Keep the documents intact in case they must be
+                    # upserted again one by one
+                    dm.bulk_upsert([dict(doc) for doc in docs])
+                else:
+                    dm.bulk_upsert(docs)
             except Exception as e:
                 if self.continue_on_error:
                     logging.exception("OplogThread: caught exception"
                                       " during bulk upsert, re-upserting"
                                       " documents serially")
-                    upsert_each(dm)
+                    upsert_each(dm, docs)
                 else:
                     raise
 
-        def do_dump(dm, error_queue):
-            try:
-                # Bulk upsert if possible
-                if hasattr(dm, "bulk_upsert"):
-                    logging.debug("OplogThread: Using bulk upsert function for "
-                                  "collection dump")
-                    upsert_all(dm)
-                else:
-                    logging.debug(
-                        "OplogThread: DocManager %s has no "
-                        "bulk_upsert method.  Upserting documents "
-                        "serially for collection dump." % str(dm))
-                    upsert_each(dm)
-            except:
-                # Likely exceptions:
-                # pymongo.errors.OperationFailure,
-                # mongo_connector.errors.ConnectionFailed
-                # mongo_connector.errors.OperationFailed
-                error_queue.put(sys.exc_info())
+        def upsert_chunk(chunk):
+            if len(self.doc_managers) == 1:
+                # DocManagers may modify the documents they are given
+                upsert_all(self.doc_managers[0], [dict(doc) for doc in chunk])
+                return
+
+            # Upsert into each target system from its own thread, so that
+            # a chunk takes as long as the slowest target system rather
+            # than all of them combined
+            failures = []
+
+            def upsert_target(dm):
+                try:
+                    upsert_all(dm, [dict(doc) for doc in chunk])
+                except Exception:
+                    failures.append(sys.exc_info()[1])
 
+            upserting_threads = [
+                threading.Thread(target=upsert_target, args=(dm,))
+                for dm in self.doc_managers]
+            for t in upserting_threads:
+                t.start()
+            for t in upserting_threads:
+                t.join()
+            if failures:
+                raise failures[0]
+
+        def dump_range(namespace, index):
+            with progress_lock:
+                lower, upper, last_id = progress["ranges"][namespace][index]
+            docs = docs_to_dump(namespace, lower, upper, last_id)
+            num_upserted = 0
+            while True:
+                chunk = list(itertools.islice(docs, self.dump_chunk_size))
+                if not chunk:
+                    break
+                last_id = chunk[-1]["_id"]
+                upsert_chunk(chunk)
+                num_upserted += len(chunk)
+                metrics.DUMP_DOCUMENTS.inc(len(chunk), shard=self.repl_set,
+                                           ns=namespace)
+                logging.debug("OplogThread: Upserted %d docs from %s",
+                              num_upserted, namespace)
+                with progress_lock:
+                    progress["ranges"][namespace][index][2] = last_id
+                    self.update_dump_progress(progress)
+            if not self.running:
+                return
+            metrics.DUMP_RANGES_REMAINING.inc(-1, shard=self.repl_set)
+            with progress_lock:
+                ranges = progress["ranges"][namespace]
+                ranges[index] = None
+                if not any(ranges):
+                    del progress["ranges"][namespace]
+                    progress["completed"].append(namespace)
+                self.update_dump_progress(progress)
+
+        def do_dump(task_queue, error_queue):
+            while error_queue.empty() and self.running:
+                try:
+                    namespace, index = task_queue.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    dump_range(namespace, index)
+                except:
+                    # Likely exceptions:
+                    # pymongo.errors.OperationFailure,
+                    # mongo_connector.errors.ConnectionFailed
+                    # mongo_connector.errors.OperationFailed
+                    error_queue.put(sys.exc_info())
+
+        # Ranges that remain to be dumped, in order
+        tasks = queue.Queue()
+        for namespace in dump_set:
+            for index, rng in enumerate(progress["ranges"].get(namespace, [])):
+                if rng is not None:
+                    tasks.put((namespace, index))
+        metrics.DUMP_RANGES_REMAINING.set(tasks.qsize(), shard=self.repl_set)
 
-        # Extra threads (if any) that assist with collection dumps
-        dumping_threads = []
         # Did the dump succeed for all target systems?
         dump_success = True
         # Holds any exceptions we can't recover from
         errors = queue.Queue()
 
-        if len(self.doc_managers) == 1:
-            do_dump(self.doc_managers[0], errors)
-        else:
-            # Slight performance gain breaking dump into separate
-            # threads if > 1 replication target
+        # Let the DocManagers prepare for the dump
+        target_namespaces = [self.dest_mapping.get(namespace, namespace)
+                             for namespace in dump_set]
+        loading = []
+        try:
             for dm in self.doc_managers:
-                t = threading.Thread(target=do_dump, args=(dm, errors))
-                dumping_threads.append(t)
-                t.start()
-            # cleanup
-            for t in dumping_threads:
-                t.join()
+                if hasattr(dm, "begin_bulk_load"):
+                    # end_bulk_load undoes a begin_bulk_load that failed
+                    loading.append(dm)
+                    dm.begin_bulk_load(target_namespaces)
+
+            if self.dump_workers > 1:
+                # Have a pool of threads upsert the ranges concurrently
+                logging.info("OplogThread: dumping %d ranges with %d threads"
+                             % (tasks.qsize(), self.dump_workers))
+                dumping_threads = []
+                for i in range(self.dump_workers):
+                    t = threading.Thread(target=do_dump,
+                                         args=(tasks, errors))
+                    dumping_threads.append(t)
+                    t.start()
+                for t in dumping_threads:
+                    t.join()
+            else:
+                do_dump(tasks, errors)
+        except:
+            errors.put(sys.exc_info())
 
         # Print caught exceptions
         try:
@@ -498,6 +961,15 @@ class OplogThread(threading.Thread):
         except queue.Empty:
             pass
 
+        for dm in loading:
+            try:
+                dm.end_bulk_load(target_namespaces,
+                                 dump_success and self.running)
+            except:
+                logging.exception("OplogThread: could not end bulk load "
+                                  "on %s", dm)
+                dump_success = False
+
         if not dump_success:
             err_msg = "OplogThread: Failed during dump collection"
             effect = "cannot recover!"
@@ -505,8 +977,88 @@ class OplogThread(threading.Thread):
             self.running = False
             return None
 
+        if not self.running:
+            # Interrupted by join(); the dump will resume on restart
+            return None
+
+        # The oplog checkpoint replaces the dump progress
+        with self.oplog_progress as oplog_prog:
+            oplog_dict = oplog_prog.get_dict()
+            oplog_dict.pop(self.dump_key(), None)
+            oplog_dict[str(self.oplog)] = timestamp
+
         return timestamp
 
+    def get_resume_query(self, last_id):
+        """Return a query for the documents that may not have been dumped
+        yet, given the ``_id`` of the last document dumped.
+
+        ``$gt`` only matches values of the same type as ``last_id``, so
+        documents whose ``_id`` is of another type are all dumped again.
+        """
+        # The type of an element is the byte following the document length
+        id_type = bytearray(bson.BSON.encode({"_id": last_id}))[4]
+        return {"$or": [{"_id": {"$gt": last_id}},
+                        {"_id": {"$not": {"$type": id_type}}}]}
+
+    def get_range_query(self, lower, upper):
+        """Return a query for the documents with an ``_id`` in
+        [``lower``, ``upper``). A bound of None means the range is unbounded
+        on that side.
+
+        MongoDB only compares values of the same type in range queries, so
+        documents whose ``_id`` is of a different type than the bounds all
+        belong to the first range.
+        """
+        if lower is None and upper is None:
+            return {}
+        elif lower is None:
+            return {"_id": {"$not": {"$gte": upper}}}
+        elif upper is None:
+            return {"_id": {"$gte": lower}}
+        return {"_id": {"$gte": lower, "$lt": upper}}
+
+    def get_split_points(self, namespace, num_ranges):
+        """Return a sorted list of ``_id`` values that split a collection
+        into about ``num_ranges`` ranges of similar size.
+
+        Split points are computed by the splitVector command when possible.
+        When it isn't available (for example through a mongos), they are
+        found by sampling the ``_id`` index instead.
+        """
+        if num_ranges < 2:
+            return []
+        database, coll = namespace.split('.', 1)
+        db = self.main_connection[database]
+        try:
+            stats = db.command("collstats", coll)
+            if not stats.get("count"):
+                return []
+            max_chunk_bytes = max(int(stats["size"] // num_ranges), 1)
+            split_points = [key["_id"] for key in db.command(
+                "splitVector", namespace, keyPattern={"_id": 1},
+                maxChunkSizeBytes=max_chunk_bytes)["splitKeys"]]
+        except pymongo.errors.OperationFailure:
+            target_coll = db[coll]
+            count = util.retry_until_ok(target_coll.count)
+            step = count // num_ranges
+            split_points = []
+            if step > 0:
+                for i in range(1, num_ranges):
+                    for doc in target_coll.find(
+                            fields=["_id"],
+                            sort=[("_id", pymongo.ASCENDING)],
+                            skip=i * step, limit=1):
+                        split_points.append(doc["_id"])
+
+        # Ranges can only be split along values of a single type
+        if len(set(type(point) for point in split_points)) > 1:
+            logging.warning("OplogThread: _id values in %s have several "
+                            "types, dumping it as a single range"
+                            % namespace)
+            return []
+        return split_points
+
     def get_last_oplog_timestamp(self):
         """Return the timestamp of the latest entry in the oplog.
         """
@@ -519,12 +1071,22 @@ class OplogThread(threading.Thread):
                 {'ns': {'$in': self.namespace_set}}
             ).sort('$natural', pymongo.DESCENDING).limit(1)
 
-        if curr.count(with_limit_and_skip=True) == 0:
-            return None
+        for entry in curr:
+            logging.debug("OplogThread: Last oplog entry has timestamp %d."
+                          % entry['ts'].time)
+            return entry['ts']
+        return None
 
-        logging.debug("OplogThread: Last oplog entry has timestamp %d."
-                      % curr[0]['ts'].time)
-        return curr[0]['ts']
+    def get_oplog_boundary(self, direction):
+        """Return the timestamp of the oldest (``direction`` is
+        ``pymongo.ASCENDING``) or newest (``pymongo.DESCENDING``) entry in
+        the oplog, regardless of namespace, or None if the oplog is empty.
+        """
+        entry = self.oplog.find_one(fields=['ts'],
+                                    sort=[('$natural', direction)])
+        if entry is None:
+            return None
+        return entry['ts']
 
     def init_cursor(self):
         """Position the cursor appropriately.
@@ -532,7 +1094,13 @@ class OplogThread(threading.Thread):
         The cursor is set to either the beginning of the oplog, or
         wherever it was last left off.
 
-        Returns the cursor and the number of documents left in the cursor.
+        Returns the cursor and whether the cursor is already up to date,
+        i.e. there is nothing in the oplog after the checkpoint.
+
+        Positioning only fetches the first oplog entry at or after the
+        checkpoint, which should be the checkpoint entry itself. If that
+        entry no longer exists, the oldest entry in the oplog tells whether
+        the checkpoint was rolled back or has fallen off the oplog.
         """
         timestamp = self.read_last_checkpoint()
 
@@ -541,63 +1109,133 @@ class OplogThread(threading.Thread):
                 # dump collection and update checkpoint
                 timestamp = self.dump_collection()
                 if timestamp is None:
-                    return None, 0
+                    return None, True
             else:
                 # Collection dump disabled:
                 # return cursor to beginning of oplog.
+                # Nothing is stored until the workers acknowledge their
+                # first batch, since a worker skips the operations at or
+                # before its checkpoint.
                 cursor = self.get_oplog_cursor()
                 self.checkpoint = self.get_last_oplog_timestamp()
-                self.update_checkpoint()
-                return cursor, retry_until_ok(cursor.count)
+                return cursor, self.checkpoint is None
 
         self.checkpoint = timestamp
         self.update_checkpoint()
 
+        start = time.time()
         for i in range(60):
             cursor = self.get_oplog_cursor(timestamp)
-            cursor_len = retry_until_ok(cursor.count)
-
-            if cursor_len == 0:
-                # rollback, update checkpoint, and retry
-                logging.debug("OplogThread: Initiating rollback from "
-                              "get_oplog_cursor")
-                self.checkpoint = self.rollback()
-                self.update_checkpoint()
-                return self.init_cursor()
 
             # try to get the first oplog entry
             try:
                 first_oplog_entry = next(cursor)
             except StopIteration:
-                # It's possible for the cursor to become invalid
-                # between the cursor.count() call and now
+                first_oplog_entry = None
+            except pymongo.errors.AutoReconnect:
                 time.sleep(1)
                 continue
 
             # first entry should be last oplog entry processed
-            cursor_ts_long = util.bson_ts_to_long(
-                first_oplog_entry.get("ts"))
             given_ts_long = util.bson_ts_to_long(timestamp)
-            if cursor_ts_long > given_ts_long:
-                # first entry in oplog is beyond timestamp
-                # we've fallen behind
-                return None, 0
+            if first_oplog_entry is None:
+                # nothing at or after the checkpoint: it was rolled back
+                rolled_back = True
+            elif (util.bson_ts_to_long(first_oplog_entry["ts"]) >
+                  given_ts_long):
+                # the checkpoint entry is gone. If the oplog still reaches
+                # back to the checkpoint, the entry was rolled back.
+                # Otherwise, we've fallen behind.
+                oldest_ts = retry_until_ok(self.get_oplog_boundary,
+                                           pymongo.ASCENDING)
+                rolled_back = (util.bson_ts_to_long(oldest_ts) <=
+                               given_ts_long)
+                if not rolled_back:
+                    self.positioning_time = time.time() - start
+                    return None, True
+            else:
+                rolled_back = False
+
+            if rolled_back:
+                # rollback, update checkpoint, and retry
+                logging.debug("OplogThread: Initiating rollback from "
+                              "get_oplog_cursor")
+                self.checkpoint = self.rollback()
+                self.update_checkpoint(reset_targets=True)
+                return self.init_cursor()
 
             # first entry has been consumed
-            return cursor, cursor_len - 1
+            newest_ts = retry_until_ok(self.get_oplog_boundary,
+                                       pymongo.DESCENDING)
+            up_to_date = (util.bson_ts_to_long(newest_ts) <= given_ts_long)
+            self.positioning_time = time.time() - start
+            logging.debug("OplogThread: positioned cursor at %s in %.3f "
+                          "seconds" % (timestamp, self.positioning_time))
+            return cursor, up_to_date
 
         else:
             raise errors.MongoConnectorError(
                 "Could not initialize oplog cursor.")
 
-    def update_checkpoint(self):
+    def target_key(self, index):
+        """Return the oplog progress key for the DocManager at ``index``."""
+        return "%s/%d" % (str(self.oplog), index)
+
+    def update_checkpoint(self, reset_targets=False):
         """Store the current checkpoint in the oplog progress dictionary.
+
+        Workers that have not applied anything yet start from the current
+        checkpoint. If ``reset_targets`` is True, every worker is moved back
+        to the current checkpoint, even if it had progressed past it.
         """
         with self.oplog_progress as oplog_prog:
             oplog_dict = oplog_prog.get_dict()
             oplog_dict[str(self.oplog)] = self.checkpoint
-            logging.debug("OplogThread: oplog checkpoint updated to %s" %
-                          str(self.checkpoint))
+            for worker in self.workers:
+                if reset_targets or worker.checkpoint is None:
+                    worker.checkpoint = self.checkpoint
+                    if len(self.workers) > 1:
+                        oplog_dict[self.target_key(worker.index)] = \
+                            self.checkpoint
+            logging.debug("OplogThread: oplog checkpoint updated to %s",
+                          self.checkpoint)
+
+    def update_target_checkpoint(self, worker):
+        """Store the checkpoint of a single worker in the oplog progress
+        dictionary.
+
+        The checkpoint of the oplog as a whole is the checkpoint of the
+        worker that is furthest behind.
+        """
+        with self.oplog_progress as oplog_prog:
+            oplog_dict = oplog_prog.get_dict()
+            if len(self.workers) > 1:
+                oplog_dict[self.target_key(worker.index)] = worker.checkpoint
+            oplog_dict[str(self.oplog)] = min(
+                w.checkpoint for w in self.workers
+                if w.checkpoint is not None)
+
+    def dump_key(self):
+        """Return the oplog progress key for the progress of a collection
+        dump.
+        """
+        return "%s/dump" % str(self.oplog)
+
+    def read_dump_progress(self):
+        """Read the progress of an interrupted collection dump from the oplog
+        progress dictionary, or None if there is no dump to resume.
+        """
+        with self.oplog_progress as oplog_prog:
+            progress = oplog_prog.get_dict().get(self.dump_key())
+            return copy.deepcopy(progress)
+
+    def update_dump_progress(self, progress):
+        """Store the progress of a collection dump in the oplog progress
+        dictionary.
+        """
+        progress = copy.deepcopy(progress)
+        with self.oplog_progress as oplog_prog:
+            oplog_prog.get_dict()[self.dump_key()] = progress
 
     def read_last_checkpoint(self):
         """Read the last checkpoint from the oplog progress dictionary.
@@ -712,14 +1350,14 @@ class OplogThread(threading.Thread):
                     try:
                         dm.remove(doc)
                         remov_inc += 1
-                        logging.debug("OplogThread: Rollback, removed %s " %
-                                      str(doc))
+                        logging.debug("OplogThread: Rollback, removed %s ",
+                                      doc)
                     except errors.OperationFailed:
                         logging.warning(
                             "Could not delete document during rollback: %s "
                             "This can happen if this document was already "
                             "removed by another rollback happening at the "
-                            "same time." % str(doc)
+                            "same time.", doc
                         )
 
                 logging.debug("OplogThread: Rollback, removed %d docs." %
@@ -15,6 +15,7 @@
 """A set of utilities used throughout the mongo-connector
 """
 
+import os
 import time
 import logging
 
@@ -39,6 +40,52 @@ def long_to_bson_ts(val):
     return Timestamp(seconds, increment)
 
 
+def cursor_batch_exhausted(cursor):
+    """Return True if getting the next document from a cursor requires a
+    round trip to the server, e.g. a tailable cursor waiting for new data.
+    """
+    # pymongo keeps the documents of the current batch in a private deque.
+    # If that changes, assume every document may require a round trip.
+    return not getattr(cursor, '_Cursor__data', None)
+
+
+def write_file_atomically(path, data, fsync=False):
+    """Replace the contents of the file at ``path`` with ``data``.
+
+    The data is written to a temporary file that is then renamed over
+    ``path``, so that readers see either the old or the new contents, never
+    a partially written file. If ``fsync`` is True, the data and the rename
+    are also flushed to disk before returning.
+    """
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, 'w') as temp_file:
+            temp_file.write(data)
+            temp_file.flush()
+            if fsync:
+                os.fsync(temp_file.fileno())
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, path)
+        elif os.name == 'nt':
+            # os.rename doesn't overwrite files on Windows before Python 3.3
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(temp_path, path)
+        else:
+            os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    if fsync and os.name == 'posix':
+        # Flush the rename, which is recorded in the directory
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
 def retry_until_ok(func, *args, **kwargs):
     """Retry code block until it succeeds.
 
@@ -24,7 +24,9 @@ from tests.test_elastic import ElasticsearchTestCase
 
 sys.path[0:0] = [""]
 
-from mongo_connector.doc_managers.elastic_doc_manager import DocManager
+from mongo_connector import errors
+from mongo_connector.doc_managers.elastic_doc_manager import (
+    BULK_IN_FLIGHT, BULK_QUEUE_DEPTH, DocManager)
 
 
 class ElasticDocManagerTester(ElasticsearchTestCase):
@@ -54,6 +56,52 @@ class ElasticDocManagerTester(ElasticsearchTestCase):
         doc = self.elastic_doc.update(self.put_metadata(doc), update_spec)
         self.assertEqual(doc, {"_id": '1', "c": 3})
 
+    def test_partial_update(self):
+        """Test the update method with partial updates."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            partial_updates=True)
+        doc = {"_id": '1', "a": 1, "b": {"c": 2, "d": 3}, "e": [1, 2]}
+        docman.upsert(self.put_metadata(doc))
+
+        def source():
+            return docman.elastic.get(index="test.test", id='1')['_source']
+
+        # top-level $set
+        update_spec = {"$set": {"a": 4, "e": [5]}}
+        self.assertEqual(docman.update(self.put_metadata({"_id": '1'}),
+                                       update_spec), None)
+        self.assertEqual(source(),
+                         {"a": 4, "b": {"c": 2, "d": 3}, "e": [5]})
+        # $set of a document replaces it
+        update_spec = {"$set": {"b": {"c": 5}}}
+        docman.update(self.put_metadata({"_id": '1'}), update_spec)
+        self.assertEqual(source(), {"a": 4, "b": {"c": 5}, "e": [5]})
+        # dotted paths and $unset
+        update_spec = {"$set": {"b.f": 6}, "$unset": {"a": True}}
+        docman.update(self.put_metadata({"_id": '1'}), update_spec)
+        self.assertEqual(source(), {"b": {"c": 5, "f": 6}, "e": [5]})
+        # metadata is updated too
+        meta = docman.elastic.get(index=docman.meta_index_name, id='1')
+        self.assertEqual(meta['_source'], {"ns": "test.test", "_ts": 1})
+
+        # a partial update that fails is reindexed, and isn't reported as
+        # dropped
+        failures = []
+        docman.bulk_failure_callback = failures.extend
+        bulk = docman.elastic.bulk
+
+        def reject_updates(body, **kwargs):
+            if "update" not in body[0]:
+                return bulk(body=body, **kwargs)
+            items = [{"index": {"status": 200}}] * (len(body) // 2)
+            items[0] = {"update": {"status": 400}}
+            return {"items": items}
+        docman.elastic.bulk = reject_updates
+        update_spec = {"$set": {"g": 7}}
+        docman.update(self.put_metadata({"_id": '1'}), update_spec)
+        self.assertEqual(source()["g"], 7)
+        self.assertEqual(failures, [])
+
     def test_upsert(self):
         """Test the upsert method."""
         docc = {'_id': '1', 'name': 'John'}
@@ -116,6 +164,95 @@ class ElasticDocManagerTester(ElasticsearchTestCase):
         res = [x["_source"] for x in res]
         self.assertEqual(len(res), 0)
 
+        # removing a document that doesn't exist is not an error
+        self.elastic_doc.remove(self.put_metadata(docc))
+
+    def test_bulk_upsert_id_only(self):
+        """Test upserting documents that have no fields besides _id."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            chunk_size=4)
+        docman.bulk_upsert([])
+        docman.bulk_upsert(self.put_metadata({"_id": str(i)})
+                           for i in range(5))
+        self.assertEqual(self._count(), 5)
+        docman.stop()
+
+    def test_bulk_errors(self):
+        """Test that failed bulk actions raise OperationFailed."""
+        self.elastic_doc.upsert(self.put_metadata({"_id": '0', "a": 1}))
+        # "a" is mapped as a number, so it can't hold a document
+        docs = [self.put_metadata({"_id": '1', "a": 2}),
+                self.put_metadata({"_id": '2', "a": {"b": 3}})]
+        self.assertRaises(errors.OperationFailed,
+                          self.elastic_doc.bulk_upsert, docs)
+        self.assertEqual(self._count(), 2)
+
+    def test_bulk_retries(self):
+        """Test that only rejected bulk actions are resent."""
+        failures = []
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            retry_backoff=0,
+                            bulk_failure_callback=failures.extend)
+        bodies = []
+        bulk = docman.elastic.bulk
+
+        def reject_first(body, **kwargs):
+            # Report the first action of the first request as rejected
+            # because of a full queue
+            bodies.append(body)
+            response = bulk(body=body, **kwargs)
+            if len(bodies) == 1:
+                response["items"][0]["index"]["status"] = 429
+            return response
+        docman.elastic.bulk = reject_first
+
+        docs = [self.put_metadata({"_id": str(i), "a": i}) for i in range(3)]
+        docman.bulk_upsert(docs)
+        self.assertEqual(len(bodies), 2)
+        # The document and its metadata were sent first, then the document
+        self.assertEqual(len(bodies[0]), 12)
+        self.assertEqual(bodies[1], bodies[0][:2])
+        self.assertEqual(failures, [])
+        self.assertEqual(self._count(), 3)
+
+        # Actions that can't succeed are dropped
+        docs = [self.put_metadata({"_id": '3', "a": {"b": 3}})]
+        self.assertRaises(errors.OperationFailed, docman.bulk_upsert, docs)
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0]["index"]["_id"], '3')
+        docman.stop()
+
+    def test_bulk_senders(self):
+        """Test sending bulk requests from several threads."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            chunk_size=10, bulk_senders=4)
+        bodies = []
+        bulk = docman.elastic.bulk
+
+        def record(body, **kwargs):
+            bodies.append(body)
+            return bulk(body=body, **kwargs)
+        docman.elastic.bulk = record
+
+        docman.bulk_upsert(self.put_metadata({"_id": str(i), "a": i})
+                           for i in range(100))
+        self.assertEqual(self._count(), 100)
+        self.assertTrue(len(bodies) >= 20)
+        # The gauges of this cluster count the requests it was sent
+        self.assertEqual(docman.metrics_target, elastic_pair)
+        self.assertEqual(BULK_IN_FLIGHT.get(target=elastic_pair), 0)
+        self.assertEqual(BULK_QUEUE_DEPTH.get(target=elastic_pair), 0)
+        # Each document is sent in the same request as its metadata
+        for body in bodies:
+            ids = [line["index"]["_id"] for line in body[::2]]
+            self.assertEqual(sorted(ids[::2]), sorted(ids[1::2]))
+
+        docman.bulk_remove(self.put_metadata({"_id": str(i)})
+                           for i in range(100))
+        self.assertEqual(self._count(), 0)
+        docman.stop()
+
     def test_search(self):
         """Test the search method.
 
@@ -137,6 +274,84 @@ class ElasticDocManagerTester(ElasticsearchTestCase):
         self.assertIn('1', result_ids)
         self.assertIn('2', result_ids)
 
+    def test_parallel_search(self):
+        """Test searching a time range with concurrent scans."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            search_slices=3, search_page_size=2,
+                            search_buffer_size=1)
+        docman.bulk_upsert({'_id': str(i), 'name': 'John', '_ts': 100 + i,
+                            'ns': 'test.test'} for i in range(20))
+        search = list(docman.search(103, 112))
+        self.assertEqual(sorted(int(doc['_id']) for doc in search),
+                         list(range(3, 13)))
+        for doc in search:
+            self.assertEqual(set(doc), set(['_id', 'ns', '_ts']))
+        # Abandoning the search stops the scans
+        search = docman.search(100, 119)
+        next(search)
+        search.close()
+        docman.stop()
+
+    def test_bulk_load(self):
+        """Test bulk loading the indices of a collection dump."""
+        docman = DocManager(elastic_pair, bulk_load=True)
+
+        def settings(index):
+            result = self.elastic_conn.indices.get_settings(
+                index=index, flat_settings=True)
+            return list(result.values())[0]["settings"]
+
+        docman.begin_bulk_load(["test.test"])
+        self.assertEqual(settings("test.test")["index.refresh_interval"],
+                         "-1")
+        self.assertEqual(settings("test.test")["index.number_of_replicas"],
+                         "0")
+        docman.bulk_upsert([self.put_metadata({"_id": '1'})])
+        docman.end_bulk_load(["test.test"], True)
+        self.assertNotEqual(
+            settings("test.test")["index.refresh_interval"], "-1")
+        self.assertEqual(self._count(), 1)
+
+        # A load that didn't finish is resumed by a new DocManager
+        docman.begin_bulk_load(["test.test"])
+        docman.stop()
+        docman = DocManager(elastic_pair, bulk_load=True)
+        docman.begin_bulk_load(["test.test"])
+        docman.end_bulk_load(["test.test"], True)
+        self.assertNotEqual(
+            settings("test.test")["index.refresh_interval"], "-1")
+        self.assertNotEqual(
+            settings("test.test")["index.number_of_replicas"], "0")
+        docman.stop()
+
+    def test_bulk_load_alias(self):
+        """Test bulk loading a new index and swapping an alias to it."""
+        docman = DocManager(elastic_pair, bulk_load=True,
+                            bulk_load_alias=True)
+        try:
+            for i in range(2):
+                docman.begin_bulk_load(["test.alias"])
+                docman.bulk_upsert([{"_id": str(i), "ns": "test.alias",
+                                     "_ts": 1}])
+                # Readers don't see the new index until the load is done
+                self.assertEqual(
+                    self.elastic_conn.indices.exists(index="test.alias"),
+                    i == 1)
+                docman.end_bulk_load(["test.alias"], True)
+                indices = list(self.elastic_conn.indices.get_alias(
+                    name="test.alias"))
+                self.assertEqual(len(indices), 1)
+                self.assertTrue(indices[0].startswith("test.alias-bulk-"))
+                hits = self.elastic_conn.search(index="test.alias")
+                self.assertEqual(
+                    [hit["_id"] for hit in hits["hits"]["hits"]], [str(i)])
+            # Writes after the load go through the alias
+            docman.upsert({"_id": '2', "ns": "test.alias", "_ts": 2})
+        finally:
+            self.elastic_conn.indices.delete(index="test.alias*",
+                                             ignore=404)
+            docman.stop()
+
     def test_elastic_commit(self):
         """Test the auto_commit_interval attribute."""
         docc = {'_id': '3', 'name': 'Waldo'}
@@ -162,6 +377,28 @@ class ElasticDocManagerTester(ElasticsearchTestCase):
             self._remove()
         docman.stop()
 
+    def test_commit_dirty_indices(self):
+        """Test that commit only refreshes the indexes written to."""
+        docman = DocManager(elastic_pair)
+        self.assertEqual(docman._dirty_indices, set())
+        docman.upsert(self.put_metadata({'_id': '1', 'name': 'John'}))
+        self.assertEqual(docman._dirty_indices,
+                         set(['test.test', docman.meta_index_name]))
+        docman.commit()
+        self.assertEqual(docman._dirty_indices, set())
+        self.assertEqual(self._count(), 1)
+
+        # commit with nothing to refresh
+        docman.commit()
+
+        # auto commit from the scheduler thread
+        docman.auto_commit_interval = 1
+        docman.run_auto_commit()
+        docman.upsert(self.put_metadata({'_id': '2', 'name': 'Paul'}))
+        time.sleep(2)
+        self.assertEqual(docman._dirty_indices, set())
+        docman.stop()
+
     def test_get_last_doc(self):
         """Test the get_last_doc method.
 
@@ -188,5 +425,36 @@ class ElasticDocManagerTester(ElasticsearchTestCase):
         self.assertEqual(
             self.elastic_doc.elastic.count(index="test.test")['count'], 3)
 
+    def test_inline_metadata(self):
+        """Test storing metadata in the documents themselves."""
+        docman = DocManager(elastic_pair, auto_commit_interval=0,
+                            inline_metadata=True, index_pattern="test.*")
+        # Recreate the index, so that the metadata fields are mapped
+        self.elastic_conn.indices.delete(index="test.test")
+        meta_count = docman.elastic.count(
+            index=docman.meta_index_name)['count']
+
+        docman.upsert({'_id': '1', 'name': 'John', '_ts': 1,
+                       'ns': 'test.test'})
+        docman.bulk_upsert([{'_id': '2', 'name': 'Paul', '_ts': 3,
+                             'ns': 'test.test'},
+                            {'_id': '3', 'name': 'George', '_ts': 2,
+                             'ns': 'test.test'}])
+        source = docman.elastic.get(index="test.test", id='1')['_source']
+        self.assertEqual(source, {'name': 'John', '_ts': 1,
+                                  'ns': 'test.test'})
+        self.assertEqual(
+            docman.elastic.count(index=docman.meta_index_name)['count'],
+            meta_count)
+
+        self.assertEqual(docman.get_last_doc(),
+                         {'_id': '2', '_ts': 3, 'ns': 'test.test'})
+        search = sorted(docman.search(1, 2), key=lambda doc: doc['_id'])
+        self.assertEqual(search, [{'_id': '1', '_ts': 1, 'ns': 'test.test'},
+                                  {'_id': '3', '_ts': 2, 'ns': 'test.test'}])
+
+        docman.remove({'_id': '2', 'ns': 'test.test'})
+        self.assertEqual(docman.get_last_doc()['_id'], '3')
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,119 @@
+# Copyright 2013-2014 MongoDB, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests methods in metrics.py
+"""
+
+import sys
+
+sys.path[0:0] = [""]
+
+if sys.version_info[:2] == (2, 6):
+    import unittest2 as unittest
+else:
+    import unittest
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+from mongo_connector.metrics import (Counter,
+                                     Gauge,
+                                     Histogram,
+                                     Registry,
+                                     start_http_server)
+
+
+class MetricsTester(unittest.TestCase):
+    """Tests the metrics
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        """Test counters and their labels"""
+        counter = self.registry.register(Counter(
+            "test_total", "A counter.", ["op"]))
+        counter.inc(op="insert")
+        counter.inc(2, op="insert")
+        counter.inc(op='with "quotes"')
+        self.assertEqual(counter.get(op="insert"), 3)
+        self.assertRaises(ValueError, counter.inc, other="label")
+        # registering the same metric again returns the existing one
+        self.assertTrue(self.registry.register(Counter(
+            "test_total", "A counter.", ["op"])) is counter)
+        self.assertRaises(ValueError, self.registry.register,
+                          Gauge("test_total", "A gauge.", ["op"]))
+        self.assertEqual(
+            self.registry.exposition(),
+            '# HELP test_total A counter.\n'
+            '# TYPE test_total counter\n'
+            'test_total{op="insert"} 3.0\n'
+            'test_total{op="with \\"quotes\\""} 1.0\n')
+
+    def test_gauge_function(self):
+        """Test gauges whose values are computed when collected"""
+        gauge = self.registry.register(Gauge("test_lag", "A gauge.",
+                                             ["shard"]))
+        values = {"a": 5, "b": None}
+        gauge.set_function(lambda: values["a"], shard="a")
+        gauge.set_function(lambda: values["b"], shard="b")
+        self.assertIn('test_lag{shard="a"} 5.0\n',
+                      self.registry.exposition())
+        self.assertNotIn('shard="b"', self.registry.exposition())
+
+        values["a"] = 7
+        self.assertEqual(gauge.get(shard="a"), 7)
+        gauge.remove(shard="a")
+        self.assertNotIn('shard="a"', self.registry.exposition())
+
+    def test_histogram(self):
+        """Test histograms"""
+        histogram = self.registry.register(Histogram(
+            "test_seconds", "A histogram.", ["method"], buckets=[1, 2]))
+        histogram.observe(0.5, method="upsert")
+        histogram.observe(1.5, method="upsert")
+        histogram.observe(3, method="upsert")
+        with histogram.time(method="remove"):
+            pass
+        self.assertEqual(histogram.get(method="upsert"), 3)
+        self.assertEqual(histogram.get(method="remove"), 1)
+        exposition = self.registry.exposition()
+        self.assertIn('test_seconds_bucket{method="upsert",le="1.0"} 1.0\n',
+                      exposition)
+        self.assertIn('test_seconds_bucket{method="upsert",le="2.0"} 2.0\n',
+                      exposition)
+        self.assertIn('test_seconds_bucket{method="upsert",le="+Inf"} 3.0\n',
+                      exposition)
+        self.assertIn('test_seconds_count{method="upsert"} 3.0\n',
+                      exposition)
+        self.assertIn('test_seconds_sum{method="upsert"} 5.0\n', exposition)
+
+    def test_http_server(self):
+        """Test serving metrics over HTTP"""
+        counter = self.registry.register(Counter("test_total", "A counter."))
+        counter.inc()
+        server = start_http_server(0, registry=self.registry)
+        try:
+            url = "http://localhost:%d/metrics" % server.server_port
+            body = urlopen(url).read().decode("utf-8")
+            self.assertEqual(body, self.registry.exposition())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
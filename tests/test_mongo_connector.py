@@ -28,6 +28,8 @@ else:
 import time
 import json
 
+from mongo_connector.checkpoint_store import (FileCheckpointStore,
+                                              MongoCheckpointStore)
 from mongo_connector.connector import Connector
 from tests import mongo_host
 from tests.setup_cluster import start_replica_set, kill_replica_set
@@ -71,6 +73,13 @@ class TestMongoConnector(unittest.TestCase):
             u_key='_id',
             auth_key=None
         )
+        closed = []
+        close = conn.checkpoint_store.close
+
+        def recording_close():
+            closed.append(True)
+            close()
+        conn.checkpoint_store.close = recording_close
         conn.start()
 
         while len(conn.shard_set) != 1:
@@ -78,6 +87,8 @@ class TestMongoConnector(unittest.TestCase):
         conn.join()
 
         self.assertFalse(conn.can_run)
+        #the checkpoint store is closed on shutdown
+        self.assertEqual(closed, [True])
         time.sleep(5)
         for thread in conn.shard_set.values():
             self.assertFalse(thread.running)
@@ -111,7 +122,7 @@ class TestMongoConnector(unittest.TestCase):
         self.assertEqual(long_to_bson_ts(int(data[1])), Timestamp(12, 34))
 
         #ensure the temp file was deleted
-        self.assertFalse(os.path.exists("temp_config.txt" + '~'))
+        self.assertFalse(os.path.exists("temp_config.txt" + '.tmp'))
 
         #ensure that updates work properly
         conn.oplog_progress.get_dict()[1] = Timestamp(44, 22)
@@ -123,6 +134,32 @@ class TestMongoConnector(unittest.TestCase):
         self.assertEqual(long_to_bson_ts(int(data[1])), Timestamp(44, 22))
 
         config_file.close()
+
+        #ensure that the file isn't written if the progress didn't change
+        os.unlink("temp_config.txt")
+        conn.write_oplog_progress()
+        self.assertFalse(os.path.exists("temp_config.txt"))
+
+        #ensure that progress of many oplogs and targets can be written
+        conn.oplog_progress.get_dict()["1/0"] = Timestamp(44, 23)
+        conn.write_oplog_progress()
+        del conn.oplog_progress.get_dict()[1]
+        del conn.oplog_progress.get_dict()["1/0"]
+        conn.read_oplog_progress()
+        self.assertEqual(conn.oplog_progress.get_dict(),
+                         {"1": Timestamp(44, 22), "1/0": Timestamp(44, 23)})
+
+        #ensure that the progress of a collection dump can be written
+        dump_progress = {"ts": Timestamp(44, 24),
+                         "completed": ["test.test"],
+                         "ranges": {"test.other": [None, [1, None, 2]]}}
+        conn.oplog_progress.get_dict()["1/dump"] = dump_progress
+        conn.write_oplog_progress()
+        conn.oplog_progress.get_dict().clear()
+        conn.read_oplog_progress()
+        self.assertEqual(conn.oplog_progress.get_dict()["1/dump"],
+                         dump_progress)
+
         os.unlink("temp_config.txt")
 
     def test_read_oplog_progress(self):
@@ -147,7 +184,7 @@ class TestMongoConnector(unittest.TestCase):
             pass
         open("temp_config.txt", "w").close()
 
-        conn.oplog_checkpoint = "temp_config.txt"
+        conn.checkpoint_store = FileCheckpointStore("temp_config.txt")
 
         #testing with empty file
         self.assertEqual(conn.read_oplog_progress(), None)
@@ -174,6 +211,50 @@ class TestMongoConnector(unittest.TestCase):
 
         os.unlink("temp_config.txt")
 
+    def test_mongo_checkpoint_store(self):
+        """Test storing oplog progress in a MongoDB collection
+        """
+        uri = "mongodb://%s:%d/test.checkpoints?replicaSet=%s" % (
+            mongo_host, self.primary_p, 'test-mongo-connector')
+        conn = Connector(
+            address='%s:%d' % (mongo_host, self.primary_p),
+            oplog_checkpoint=uri,
+            target_url=None,
+            ns_set=['test.test'],
+            u_key='_id',
+            auth_key=None,
+            checkpoint_name='primary'
+        )
+        self.assertTrue(isinstance(conn.checkpoint_store,
+                                   MongoCheckpointStore))
+        collection = conn.checkpoint_store.collection
+        collection.remove()
+
+        #nothing stored yet
+        self.assertEqual(conn.read_oplog_progress(), None)
+
+        dump_progress = {"ts": Timestamp(44, 24),
+                         "completed": ["test.test"],
+                         "ranges": {"test.other": [None, [1, None, 2]]}}
+        oplog_dict = conn.oplog_progress.get_dict()
+        oplog_dict['oplog1'] = Timestamp(12, 34)
+        oplog_dict['oplog1/dump'] = dump_progress
+        conn.write_oplog_progress()
+        self.assertEqual(collection.count(), 1)
+
+        #a standby with the same name picks up the progress
+        standby = MongoCheckpointStore(uri, 'primary')
+        self.assertEqual(standby.read(), {'oplog1': Timestamp(12, 34),
+                                          'oplog1/dump': dump_progress})
+        #but not one with another name
+        self.assertEqual(MongoCheckpointStore(uri, 'other').read(), None)
+
+        oplog_dict['oplog1'] = Timestamp(55, 11)
+        del oplog_dict['oplog1/dump']
+        conn.write_oplog_progress()
+        self.assertEqual(standby.read(), {'oplog1': Timestamp(55, 11)})
+        collection.remove()
+
     def test_many_targets(self):
         """Test that DocManagers are created and assigned to target URLs
         correctly when instantiating a Connector object with multiple target
@@ -117,6 +117,31 @@ class MongoDocManagerTester(unittest.TestCase):
         for doc in res:
             self.assertTrue(doc['_id'] == '1' and doc['name'] == 'Paul')
 
+    def test_bulk_upsert_remove(self):
+        """Test upserting and removing many documents at once."""
+        docman = DocManager(self.standalone_pair, chunk_size=30,
+                            write_concern={"w": 1})
+        namespaces = ["test.test", "test.test_include1"]
+        docman.bulk_upsert({'_id': i, 'name': 'John',
+                            'ns': namespaces[i % 2], '_ts': i}
+                           for i in range(100))
+        coll = self.mongo_conn["test"]["test_include1"]
+        self.assertEqual(self.mongo.count(), 50)
+        self.assertEqual(coll.count(), 50)
+        meta = self.mongo_conn["__mongo_connector"]["test.test"]
+        self.assertEqual(meta.find_one({'_id': 2}),
+                         {'_id': 2, '_ts': 2, 'ns': 'test.test'})
+
+        docman.bulk_upsert({'_id': i, 'name': 'Paul', 'ns': 'test.test',
+                            '_ts': 200} for i in range(0, 100, 2))
+        self.assertEqual(self.mongo.find({'name': 'Paul'}).count(), 50)
+
+        docman.bulk_remove({'_id': i, 'ns': namespaces[i % 2], '_ts': 300}
+                           for i in range(0, 100, 4))
+        self.assertEqual(self.mongo.count(), 25)
+        self.assertEqual(coll.count(), 50)
+        self.assertEqual(meta.count(), 25)
+
     def test_remove(self):
         """Ensure we can properly delete from Mongo via DocManager.
         """
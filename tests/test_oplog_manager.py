@@ -15,6 +15,7 @@
 """Test oplog manager methods
 """
 
+import logging
 import time
 import sys
 if sys.version_info[:2] == (2, 6):
@@ -25,9 +26,11 @@ else:
 import bson
 import pymongo
 
+from mongo_connector import errors
 from mongo_connector.doc_managers.doc_manager_simulator import DocManager
 from mongo_connector.locking_dict import LockingDict
 from mongo_connector.oplog_manager import OplogThread
+from mongo_connector.util import bson_ts_to_long
 from tests import mongo_host
 from tests.setup_cluster import (start_replica_set,
                                  kill_replica_set)
@@ -139,6 +142,97 @@ class TestOplogManager(unittest.TestCase):
         self.assertEqual(last_ts, self.opman.dump_collection())
         self.assertEqual(len(self.opman.doc_managers[0]._search()), 1000)
 
+    def test_dump_collection_parallel(self):
+        """Test the dump_collection method with several dump workers."""
+        self.opman.dump_workers = 4
+        collection = self.primary_conn["test"]["test"]
+        collection.insert({"i": i} for i in range(1000))
+        # _id of a different type than the split points
+        collection.insert({"_id": "string id", "i": 1000})
+
+        split_points = self.opman.get_split_points("test.test", 4)
+        self.assertTrue(0 < len(split_points) < 4)
+        self.assertEqual(split_points, sorted(split_points))
+
+        last_ts = self.opman.get_last_oplog_timestamp()
+        self.assertEqual(last_ts, self.opman.dump_collection())
+        docs = self.opman.doc_managers[0]._search()
+        self.assertEqual(sorted(doc["i"] for doc in docs), list(range(1001)))
+
+    def test_dump_collection_many_targets(self):
+        """Test the dump_collection method with several target systems."""
+        doc_managers = [DocManager(), DocManager(), DocManager()]
+        self.opman.doc_managers = doc_managers
+        self.opman.dump_chunk_size = 10
+        self.primary_conn["test"]["test"].insert(
+            {"_id": i} for i in range(25))
+
+        last_ts = self.opman.get_last_oplog_timestamp()
+        self.assertEqual(last_ts, self.opman.dump_collection())
+        for docman in doc_managers:
+            self.assertEqual(sorted(doc["_id"] for doc in docman._search()),
+                             list(range(25)))
+
+    def test_dump_collection_resume(self):
+        """Test that dump_collection resumes an interrupted dump."""
+        self.primary_conn["test"]["test"].insert(
+            {"_id": i} for i in range(100))
+        self.primary_conn["test"]["other"].insert({"_id": 0})
+        self.opman.namespace_set = ["test.test", "test.other"]
+
+        start_ts = self.opman.get_last_oplog_timestamp()
+        self.opman.update_dump_progress({
+            "ts": start_ts,
+            "completed": ["test.other"],
+            "ranges": {"test.test": [[None, None, 49]]}
+        })
+        self.assertEqual(self.opman.dump_collection(), start_ts)
+
+        docs = self.opman.doc_managers[0]._search()
+        self.assertEqual(sorted(doc["_id"] for doc in docs),
+                         list(range(50, 100)))
+        for doc in docs:
+            self.assertEqual(doc["_ts"], bson_ts_to_long(start_ts))
+        self.assertEqual(self.opman.read_dump_progress(), None)
+        self.assertEqual(self.opman.read_last_checkpoint(), start_ts)
+
+        # Documents with an _id of another type are dumped as well
+        self.opman.doc_managers[0]._delete()
+        self.primary_conn["test"]["test"].insert(
+            [{"_id": "string id"}, {"_id": bson.ObjectId()}])
+        self.opman.oplog_progress = LockingDict()
+        self.opman.update_dump_progress({
+            "ts": start_ts,
+            "completed": ["test.other"],
+            "ranges": {"test.test": [[None, None, 49]]}
+        })
+        self.assertEqual(self.opman.dump_collection(), start_ts)
+        self.assertEqual(len(self.opman.doc_managers[0]._search()), 52)
+
+    def test_dump_collection_stripped(self):
+        """Test that dump_collection records its progress when the
+        DocManager strips the documents it is given.
+        """
+        class StrippingDocManager(DocManager):
+            def bulk_upsert(self, docs):
+                for doc in docs:
+                    # Like the Elasticsearch DocManager, strip the _id and
+                    # metadata
+                    self.upsert({'_id': doc.pop('_id'),
+                                 'ns': doc.pop('ns'),
+                                 '_ts': doc.pop('_ts')})
+
+        docman = StrippingDocManager()
+        self.opman.doc_managers = [docman]
+        self.opman.dump_chunk_size = 10
+        self.primary_conn["test"]["test"].insert(
+            {"_id": i} for i in range(25))
+
+        last_ts = self.opman.get_last_oplog_timestamp()
+        self.assertEqual(last_ts, self.opman.dump_collection())
+        self.assertEqual(sorted(doc["_id"] for doc in docman._search()),
+                         list(range(25)))
+
     def test_dump_collection_with_error(self):
         """Test the dump_collection method with invalid documents.
 
@@ -192,9 +286,9 @@ class TestOplogManager(unittest.TestCase):
 
         # No last checkpoint, empty collections, nothing in oplog
         self.opman.collection_dump = True
-        cursor, cursor_len = self.opman.init_cursor()
+        cursor, cursor_empty = self.opman.init_cursor()
         self.assertEqual(cursor, None)
-        self.assertEqual(cursor_len, 0)
+        self.assertTrue(cursor_empty)
         self.assertEqual(self.opman.checkpoint, None)
 
         # No last checkpoint, empty collections, something in oplog
@@ -204,8 +298,8 @@ class TestOplogManager(unittest.TestCase):
         collection.remove({"i": 1})
         time.sleep(3)
         last_ts = self.opman.get_last_oplog_timestamp()
-        cursor, cursor_len = self.opman.init_cursor()
-        self.assertEqual(cursor_len, 0)
+        cursor, cursor_empty = self.opman.init_cursor()
+        self.assertTrue(cursor_empty)
         self.assertEqual(self.opman.checkpoint, last_ts)
         with self.opman.oplog_progress as prog:
             self.assertEqual(prog.get_dict()[str(self.opman.oplog)], last_ts)
@@ -215,10 +309,9 @@ class TestOplogManager(unittest.TestCase):
         self.opman.collection_dump = False
         collection.insert({"i": 2})
         last_ts = self.opman.get_last_oplog_timestamp()
-        cursor, cursor_len = self.opman.init_cursor()
-        for i in range(cursor_len - 1):
-            next(cursor)
-        self.assertEqual(next(cursor)['o']['i'], 2)
+        cursor, cursor_empty = self.opman.init_cursor()
+        self.assertFalse(cursor_empty)
+        self.assertEqual(list(cursor)[-1]['o']['i'], 2)
         self.assertEqual(self.opman.checkpoint, last_ts)
 
         # Last checkpoint exists
@@ -231,7 +324,9 @@ class TestOplogManager(unittest.TestCase):
         progress.get_dict()[str(self.opman.oplog)] = entry[0]["ts"]
         self.opman.oplog_progress = progress
         self.opman.checkpoint = None
-        cursor, cursor_len = self.opman.init_cursor()
+        cursor, cursor_empty = self.opman.init_cursor()
+        self.assertFalse(cursor_empty)
+        self.assertIsNotNone(self.opman.positioning_time)
         self.assertEqual(next(cursor)["ts"], entry[1]["ts"])
         self.assertEqual(self.opman.checkpoint, entry[0]["ts"])
         with self.opman.oplog_progress as prog:
@@ -243,8 +338,8 @@ class TestOplogManager(unittest.TestCase):
         progress.get_dict()[str(self.opman.oplog)] = bson.Timestamp(1, 0)
         self.opman.oplog_progress = progress
         self.opman.checkpoint = None
-        cursor, cursor_len = self.opman.init_cursor()
-        self.assertEqual(cursor_len, 0)
+        cursor, cursor_empty = self.opman.init_cursor()
+        self.assertTrue(cursor_empty)
         self.assertEqual(cursor, None)
         self.assertIsNotNone(self.opman.checkpoint)
 
@@ -383,6 +478,157 @@ class TestOplogManager(unittest.TestCase):
         for d in doc_managers:
             self.assertEqual(d._search()[0]["name"], "kermit")
 
+        # Each target system records its own progress
+        last_ts = self.opman.get_last_oplog_timestamp()
+        with self.opman.oplog_progress as prog:
+            progress = prog.get_dict()
+            for i in range(len(doc_managers)):
+                self.assertEqual(progress[self.opman.target_key(i)], last_ts)
+            self.assertEqual(progress[str(self.opman.oplog)], last_ts)
+
+    def test_tailing(self):
+        """Test that OplogThread keeps the same cursor open while idle."""
+        init_cursor = self.opman.init_cursor
+        calls = []
+
+        def counting_init_cursor():
+            calls.append(1)
+            return init_cursor()
+        self.opman.init_cursor = counting_init_cursor
+
+        docman = self.opman.doc_managers[0]
+        self.opman.start()
+        self.primary_conn["test"]["test"].insert({"name": "kermit"})
+        assert_soon(lambda: len(docman._search()) == 1)
+
+        # Nothing happens for a few seconds
+        time.sleep(3)
+        self.primary_conn["test"]["test"].insert({"name": "elmo"})
+        assert_soon(lambda: len(docman._search()) == 2)
+        self.assertEqual(len(calls), 1)
+
+    def test_no_dump(self):
+        """Test that OplogThread applies the existing oplog entries when the
+        collection dump is disabled.
+        """
+        collection = self.primary_conn["test"]["test"]
+        collection.insert({"name": "kermit"})
+        collection.insert({"name": "elmo"})
+        docman = self.opman.doc_managers[0]
+        self.opman.collection_dump = False
+        self.opman.start()
+        assert_soon(lambda: len(docman._search()) == 2,
+                    "OplogThread should apply existing oplog entries")
+
+    def test_get_lag(self):
+        """Test that entries outside of the namespace set don't count towards
+        the lag.
+        """
+        self.opman.namespace_set = ["test.test"]
+        docman = self.opman.doc_managers[0]
+        self.opman.start()
+        self.primary_conn["test"]["test"].insert({"name": "kermit"})
+        assert_soon(lambda: len(docman._search()) == 1)
+        assert_soon(lambda: self.opman.get_lag() == 0)
+
+        # Only other namespaces are written to for a few seconds
+        time.sleep(3)
+        self.primary_conn["test"]["other"].insert({"name": "elmo"})
+        time.sleep(1)
+        self.assertEqual(self.opman.get_lag(), 0)
+
+    def test_log_summary(self):
+        """Test that OplogThread summarizes the operations it has read."""
+        messages = []
+
+        class RecordingHandler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        handler = RecordingHandler()
+        logging.getLogger().addHandler(handler)
+        try:
+            self.opman.summary_interval = 3600
+            self.opman.log_summary()
+            self.assertEqual(messages, [])
+
+            self.opman.entries_read = 4
+            self.opman.counts = {'d': 1, 'i': 2, 'u': 0}
+            self.opman.log_summary(force=True)
+            self.assertEqual(len(messages), 1)
+            self.assertIn("4 entries read, 1 documents removed, 2 upserted, "
+                          "0 updated", messages[0])
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+    def test_apply_operations(self):
+        """Test that consecutive inserts and removes are applied in bulk,
+        and that operations are applied in order.
+        """
+        calls = []
+
+        class RecordingDocManager(DocManager):
+            def bulk_upsert(self, docs):
+                docs = list(docs)
+                calls.append(('bulk_upsert', [d['_id'] for d in docs]))
+                super(RecordingDocManager, self).bulk_upsert(docs)
+
+            def bulk_remove(self, docs):
+                docs = list(docs)
+                calls.append(('bulk_remove', [d['_id'] for d in docs]))
+                super(RecordingDocManager, self).bulk_remove(docs)
+
+            def update(self, doc, update_spec):
+                calls.append(('update', [doc['_id']]))
+                return super(RecordingDocManager, self).update(
+                    doc, update_spec)
+
+        docman = RecordingDocManager()
+        operations = [
+            ('i', {'_id': 1, 'ns': 'test.test', '_ts': 1}, None),
+            ('i', {'_id': 2, 'ns': 'test.test', '_ts': 2}, None),
+            ('i', {'_id': 3, 'ns': 'test.test', '_ts': 3}, None),
+            ('u', {'_id': 1, 'ns': 'test.test', '_ts': 4}, {'$set': {'a': 1}}),
+            ('d', {'_id': 2, 'ns': 'test.test', '_ts': 5}, None),
+            ('d', {'_id': 3, 'ns': 'test.test', '_ts': 6}, None),
+        ]
+        self.opman.apply_operations(docman, operations)
+
+        self.assertEqual(calls, [('bulk_upsert', [1, 2, 3]),
+                                 ('update', [1]),
+                                 ('bulk_remove', [2, 3])])
+        docs = docman._search()
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['a'], 1)
+
+        # A failed bulk call is retried one operation at a time
+        self.opman.apply_operations(docman, [
+            ('d', {'_id': 1, 'ns': 'test.test', '_ts': 7}, None),
+            ('d', {'_id': 42, 'ns': 'test.test', '_ts': 8}, None),
+        ])
+        self.assertEqual(len(docman._search()), 0)
+
+    def test_apply_operations_bulk_failure(self):
+        """Test that operations are applied one at a time after a bulk call
+        that modified its documents failed.
+        """
+        class FailingDocManager(DocManager):
+            def bulk_upsert(self, docs):
+                for doc in docs:
+                    # Like the Elasticsearch DocManager, strip the metadata
+                    doc.pop('ns')
+                    doc.pop('_ts')
+                raise errors.OperationFailed("bulk upsert rejected")
+
+        docman = FailingDocManager()
+        self.opman.apply_operations(docman, [
+            ('i', {'_id': 1, 'ns': 'test.test', '_ts': 1}, None),
+            ('i', {'_id': 2, 'ns': 'test.test', '_ts': 2}, None),
+        ])
+        docs = docman._search()
+        self.assertEqual(sorted(doc['_id'] for doc in docs), [1, 2])
+        for doc in docs:
+            self.assertEqual(doc['ns'], 'test.test')
+
     def test_filter_oplog_entry(self):
         # Test oplog entries: these are callables, since
         # filter_oplog_entry modifies the oplog entry in-place
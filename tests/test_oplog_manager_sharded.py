@@ -329,13 +329,13 @@ class TestOplogManagerSharded(unittest.TestCase):
         # No last checkpoint, empty collections, nothing in oplog
         self.opman1.collection_dump = self.opman2.collection_dump = True
 
-        cursor, cursor_len = self.opman1.init_cursor()
+        cursor, cursor_empty = self.opman1.init_cursor()
         self.assertEqual(cursor, None)
-        self.assertEqual(cursor_len, 0)
+        self.assertTrue(cursor_empty)
         self.assertEqual(self.opman1.checkpoint, None)
-        cursor, cursor_len = self.opman2.init_cursor()
+        cursor, cursor_empty = self.opman2.init_cursor()
         self.assertEqual(cursor, None)
-        self.assertEqual(cursor_len, 0)
+        self.assertTrue(cursor_empty)
         self.assertEqual(self.opman2.checkpoint, None)
 
         # No last checkpoint, empty collections, something in oplog
@@ -347,14 +347,14 @@ class TestOplogManagerSharded(unittest.TestCase):
         collection.remove({"i": 1})
         time.sleep(3)
         last_ts1 = self.opman1.get_last_oplog_timestamp()
-        cursor, cursor_len = self.opman1.init_cursor()
-        self.assertEqual(cursor_len, 0)
+        cursor, cursor_empty = self.opman1.init_cursor()
+        self.assertTrue(cursor_empty)
         self.assertEqual(self.opman1.checkpoint, last_ts1)
         with self.opman1.oplog_progress as prog:
             self.assertEqual(prog.get_dict()[str(self.opman1.oplog)], last_ts1)
         # init_cursor should point to startup message in shard2 oplog
-        cursor, cursor_len = self.opman2.init_cursor()
-        self.assertEqual(cursor_len, 0)
+        cursor, cursor_empty = self.opman2.init_cursor()
+        self.assertTrue(cursor_empty)
         self.assertEqual(self.opman2.checkpoint, oplog_startup_ts)
 
         # No last checkpoint, no collection dump, stuff in oplog
@@ -365,15 +365,15 @@ class TestOplogManagerSharded(unittest.TestCase):
         last_ts2 = self.opman2.get_last_oplog_timestamp()
         self.opman1.init_cursor()
         self.assertEqual(self.opman1.checkpoint, last_ts1)
+        # Nothing is stored until the workers have applied a batch
         with self.opman1.oplog_progress as prog:
-            self.assertEqual(prog.get_dict()[str(self.opman1.oplog)], last_ts1)
-        cursor, cursor_len = self.opman2.init_cursor()
-        for i in range(cursor_len - 1):
-            next(cursor)
-        self.assertEqual(next(cursor)["o"]["i"], 1200)
+            self.assertNotIn(str(self.opman1.oplog), prog.get_dict())
+        cursor, cursor_empty = self.opman2.init_cursor()
+        self.assertFalse(cursor_empty)
+        self.assertEqual(list(cursor)[-1]["o"]["i"], 1200)
         self.assertEqual(self.opman2.checkpoint, last_ts2)
         with self.opman2.oplog_progress as prog:
-            self.assertEqual(prog.get_dict()[str(self.opman2.oplog)], last_ts2)
+            self.assertNotIn(str(self.opman2.oplog), prog.get_dict())
 
         # Last checkpoint exists
         progress = LockingDict()
@@ -388,8 +388,8 @@ class TestOplogManagerSharded(unittest.TestCase):
         progress.get_dict()[str(self.opman2.oplog)] = entry2[0]["ts"]
         self.opman1.oplog_progress = self.opman2.oplog_progress = progress
         self.opman1.checkpoint = self.opman2.checkpoint = None
-        cursor1, cursor_len1 = self.opman1.init_cursor()
-        cursor2, cursor_len2 = self.opman2.init_cursor()
+        cursor1, cursor_empty1 = self.opman1.init_cursor()
+        cursor2, cursor_empty2 = self.opman2.init_cursor()
         self.assertEqual(entry1[1]["ts"], next(cursor1)["ts"])
         self.assertEqual(entry2[1]["ts"], next(cursor2)["ts"])
         self.assertEqual(self.opman1.checkpoint, entry1[0]["ts"])
@@ -407,12 +407,12 @@ class TestOplogManagerSharded(unittest.TestCase):
         progress.get_dict()[str(self.opman2.oplog)] = bson.Timestamp(1, 0)
         self.opman1.oplog_progress = self.opman2.oplog_progress = progress
         self.opman1.checkpoint = self.opman2.checkpoint = None
-        cursor, cursor_len = self.opman1.init_cursor()
-        self.assertEqual(cursor_len, 0)
+        cursor, cursor_empty = self.opman1.init_cursor()
+        self.assertTrue(cursor_empty)
         self.assertEqual(cursor, None)
         self.assertIsNotNone(self.opman1.checkpoint)
-        cursor, cursor_len = self.opman2.init_cursor()
-        self.assertEqual(cursor_len, 0)
+        cursor, cursor_empty = self.opman2.init_cursor()
+        self.assertTrue(cursor_empty)
         self.assertEqual(cursor, None)
         self.assertIsNotNone(self.opman2.checkpoint)
 
@@ -21,7 +21,8 @@ else:
 
 sys.path[0:0] = [""]
 
-from mongo_connector.doc_managers.solr_doc_manager import DocManager
+from mongo_connector.doc_managers.solr_doc_manager import (DocManager,
+                                                          FieldMatcher)
 from pysolr import Solr
 
 
@@ -75,6 +76,78 @@ class SolrDocManagerTester(unittest.TestCase):
             self.assertEqual(doc[k], v)
         self.assertNotIn("description", doc)
 
+    def test_atomic_update(self):
+        """Test the update method with atomic updates."""
+        docman = DocManager("http://localhost:8983/solr/",
+                            auto_commit_interval=0, atomic_updates=True)
+        doc = {"_id": '1', "ns": "test.test", "_ts": 1,
+               "title": "abc", "description": "def", "numbers": [1, 2]}
+        docman.upsert(dict(doc))
+
+        def stored():
+            return list(self.solr.search("_id:1"))[0]
+
+        # $set and $unset are applied without reading the document
+        update_spec = {"$set": {"title": "qaz"},
+                       "$unset": {"description": True}}
+        self.assertEqual(docman.update(dict(doc, _ts=2), update_spec), None)
+        result = stored()
+        self.assertEqual(result["title"], "qaz")
+        self.assertEqual(result["_ts"], 2)
+        self.assertNotIn("description", result)
+
+        # Fields with declared subfields are reindexed
+        update_spec = {"$unset": {"numbers": True}}
+        doc = docman.update(dict(doc, _ts=3), update_spec)
+        self.assertNotIn("numbers.0", doc)
+        self.assertNotIn("numbers.0", stored())
+        self.assertEqual(stored()["title"], "qaz")
+
+        # Missing documents are not created
+        update_spec = {"$set": {"title": "qaz"}}
+        missing = {"_id": '2', "ns": "test.test", "_ts": 4}
+        self.assertEqual(docman.update(missing, update_spec), None)
+        self.assertEqual(len(self.solr.search("_id:2")), 0)
+
+    def test_update_uncommitted(self):
+        """Test updating documents that haven't been committed yet."""
+        docman = DocManager("http://localhost:8983/solr/", chunk_size=2)
+        for i in range(3):
+            docman.upsert({"_id": str(i), "ns": "test.test", "_ts": 1,
+                           "title": "abc"})
+        doc = docman.update({"_id": '1', "ns": "test.test", "_ts": 2},
+                            {"$set": {"title": "qaz"}})
+        self.assertEqual(doc["title"], "qaz")
+        # Nothing was committed
+        self.assertEqual(len(self.solr.search("*:*")), 0)
+
+        docs = list(docman._get_documents(['0', '1', '2', '3']))
+        self.assertEqual(sorted(d["_id"] for d in docs), ['0', '1', '2'])
+        docman.commit()
+
+    def test_field_matcher(self):
+        """Test matching fields against the fields of a schema."""
+        matcher = FieldMatcher(["_id", "title"],
+                               ["*_i", "i_*", "numbers.*"], memo_size=2)
+        for field in ["title", "foo_i", "i_foo", "numbers.0"]:
+            self.assertTrue(matcher.matches(field))
+        for field in ["foo", "numbers", "title.0"]:
+            self.assertFalse(matcher.matches(field))
+        self.assertTrue(matcher.may_have_subfields("numbers"))
+        self.assertFalse(matcher.may_have_subfields("title"))
+        # Without a schema, every field matches
+        self.assertTrue(FieldMatcher().matches("foo"))
+
+    def test_schema_refresh(self):
+        """Test reloading the schema periodically."""
+        docman = DocManager("http://localhost:8983/solr/",
+                            schema_refresh_interval=0.1)
+        matcher = docman._field_matcher
+        self.assertTrue(matcher.matches("foo_i"))
+        time.sleep(0.5)
+        self.assertFalse(docman._field_matcher is matcher)
+        docman.stop()
+
     def test_upsert(self):
         """Ensure we can properly insert into Solr via DocManager.
         """
@@ -116,6 +189,19 @@ class SolrDocManagerTester(unittest.TestCase):
         for i, r in enumerate(res):
             self.assertEqual(r, 2*i)
 
+    def test_bulk_upsert_concurrent(self):
+        """Test upserting chunks of documents concurrently."""
+        docman = DocManager("http://localhost:8983/solr/",
+                            auto_commit_interval=0, chunk_size=100,
+                            bulk_senders=3)
+        # The last chunk is partial
+        docs = ({"_id": str(i), "ns": "test.test", "_ts": 1,
+                 "title": "doc %d" % i} for i in range(1050))
+        docman.bulk_upsert(docs)
+        res = self.solr.search("*:*", rows=2000)
+        self.assertEqual(sorted(int(doc["_id"]) for doc in res),
+                         list(range(1050)))
+
     def test_remove(self):
         """Ensure we can properly delete from Solr via DocManager.
         """
@@ -129,6 +215,18 @@ class SolrDocManagerTester(unittest.TestCase):
         res = self.solr.search('*:*')
         self.assertTrue(len(res) == 0)
 
+    def test_bulk_remove(self):
+        """Test removing many documents at once."""
+        docman = DocManager("http://localhost:8983/solr/",
+                            auto_commit_interval=0, chunk_size=30)
+        docman.bulk_upsert({"_id": str(i), "ns": "test.test", "_ts": 1}
+                           for i in range(100))
+        docman.bulk_remove({"_id": str(i), "ns": "test.test", "_ts": 2}
+                           for i in range(0, 100, 2))
+        res = self.solr.search("*:*", rows=200)
+        self.assertEqual(sorted(int(doc["_id"]) for doc in res),
+                         list(range(1, 100, 2)))
+
     def test_full_search(self):
         """Query Solr for all docs via API and via DocManager's _search()
         """
@@ -166,6 +264,20 @@ class SolrDocManagerTester(unittest.TestCase):
         self.assertIn('John', result_names)
         self.assertIn('John Paul', result_names)
 
+    def test_search_pages(self):
+        """Test paging through search results."""
+        docman = DocManager("http://localhost:8983/solr/",
+                            auto_commit_interval=0, search_page_size=7)
+        docman.bulk_upsert({"_id": str(i), "ns": "test.test", "_ts": i,
+                            "name": "John"} for i in range(50))
+        search = list(docman.search(10, 39))
+        self.assertEqual(sorted(int(doc["_id"]) for doc in search),
+                         list(range(10, 40)))
+        for doc in search:
+            self.assertEqual(set(doc) - set(["_version_"]),
+                             set(["_id", "ns", "_ts"]))
+        self.assertEqual(len(list(docman._search("*:*"))), 50)
+
     def test_solr_commit(self):
         """Test that documents get properly added to Solr.
         """